@@ -11,8 +11,68 @@ def create_app(test_config: Mapping[str, Any] | None = None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY=os.environ.get("SECRET_KEY", "dev"),
+        TOKEN_CACHE_SIZE=4096,
+        REVOCATION_SYNC_INTERVAL=1.0,
+        ACCESS_TOKEN_LIFETIME=15 * 60,
+        REFRESH_TOKEN_LIFETIME=14 * 24 * 3600,
+        REFRESH_TOKEN_MAX_LIFETIME=90 * 24 * 3600,
+        # gunicorn takes its default worker count from WEB_CONCURRENCY too.
+        WEB_WORKERS=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        PASSWORD_HASH_WORKERS=None,
+        PASSWORD_HASH_CONCURRENCY=None,
+        PASSWORD_HASH_TIMEOUT=5.0,
+        PASSWORD_HASH_NICE=5,
         DATABASE=os.path.join(app.instance_path, "database.sqlite"),
+        DATABASE_POOL_SIZE=5,
+        DATABASE_POOL_TIMEOUT=30.0,
+        DATABASE_JOURNAL_MODE="WAL",
+        DATABASE_SYNCHRONOUS="NORMAL",
+        DATABASE_CACHE_SIZE=-16000,
+        DATABASE_MMAP_SIZE=64 * 1024 * 1024,
+        DATABASE_BUSY_TIMEOUT=5000,
+        # Group-commits concurrent single-statement writes. The Dockerfile's
+        # gthread workers and the dev server both run requests in threads.
+        DATABASE_WRITE_QUEUE=True,
+        DATABASE_WRITE_BATCH_SIZE=64,
+        DATABASE_FETCH_SIZE=500,
         FILE_STORE=os.path.join(app.instance_path, "files"),
+        FILE_STORE_SHARD_DEPTH=2,
+        FILE_STORE_SHARD_WIDTH=2,
+        FILE_STORE_COMPRESSION=None,
+        FILE_STORE_COMPRESSION_LEVEL=None,
+        UPLOAD_CHUNK_SIZE=1024 * 1024,
+        UPLOAD_MAX_SIZE=None,
+        UPLOAD_MAX_ARCHIVE_MEMBERS=10000,
+        UPLOAD_MAX_ARCHIVE_BYTES=4 * 1024 * 1024 * 1024,
+        UPLOAD_MAX_ARCHIVE_RATIO=100,
+        UPLOAD_SESSION_CHUNK_SIZE=8 * 1024 * 1024,
+        UPLOAD_SESSION_MAX_SIZE=16 * 1024 * 1024 * 1024,
+        UPLOAD_SESSION_TTL=24 * 3600,
+        USER_QUOTA_BYTES=None,
+        DOWNLOAD_MAX_RANGES=16,
+        DASHBOARD_PAGE_SIZE=50,
+        DASHBOARD_MAX_PAGE_SIZE=500,
+        ACCESS_LOG=None,
+        ACCESS_LOG_MAX_QUEUE=10000,
+        ACCESS_LOG_BATCH_SIZE=256,
+        ACCESS_LOG_FLUSH_INTERVAL=1.0,
+        ACCESS_LOG_MAX_BYTES=100 * 1024 * 1024,
+        ACCESS_LOG_ROTATE_INTERVAL=0,
+        ACCESS_LOG_BACKUP_COUNT=5,
+        RATE_LIMIT_LOGIN_IP=(30, 60.0),
+        RATE_LIMIT_LOGIN_USERNAME=(5, 300.0),
+        RATE_LIMIT_UPLOAD=(120, 60.0),
+        RATE_LIMIT_RETENTION=24 * 3600,
+        JOBS_BATCH_SIZE=200,
+        JOBS_LEASE=300.0,
+        JOBS_MAX_ATTEMPTS=5,
+        JOBS_RETRY_DELAY=30.0,
+        JOBS_POLL_INTERVAL=2.0,
+        JOBS_RETENTION=7 * 24 * 3600,
+        METRICS_ENABLED=False,
+        METRICS_TOKEN=None,
+        METRICS_DIR=None,
+        METRICS_SYNC_INTERVAL=5.0,
     )
 
     if test_config is None:
@@ -23,18 +83,24 @@ def create_app(test_config: Mapping[str, Any] | None = None):
     os.makedirs(app.instance_path, exist_ok=True)
     os.makedirs(app.config["FILE_STORE"], exist_ok=True)
 
-    from . import admin, auth, files, db
+    from . import admin, auth, files, db, jobs, provisioning, ratelimit, resumable, storage
 
     db.init_app(app)
+    jobs.init_app(app)
+    storage.init_app(app)
+    provisioning.init_app(app)
     app.register_blueprint(auth.bp)
     app.register_blueprint(admin.bp)
     app.register_blueprint(files.bp)
+    app.register_blueprint(resumable.bp)
+    ratelimit.init_app(app)
 
     from .utils import format_size
 
     app.jinja_env.filters["format_size"] = format_size
 
-    from .observability import initialize_logging
+    from .observability import initialize_logging, initialize_metrics
     initialize_logging(app)
+    initialize_metrics(app)
 
     return app
\ No newline at end of file
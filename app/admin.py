@@ -1,18 +1,20 @@
-from pathlib import Path
-
 from flask import (
     Blueprint,
-    current_app,
     flash,
+    jsonify,
+    make_response,
     redirect,
-    render_template,
     request,
     url_for,
 )
-from werkzeug.security import generate_password_hash
 
-from app.auth import auth_required
-from app.db import query_db
+from app.auth import auth_required, revoke_refresh_tokens
+from app.db import query_db, transaction, write_db
+from app.jobs import enqueue, recent_jobs
+from app.pagination import keyset_page
+from app.passwords import HashPoolBusy, hash_password
+from app.provisioning import ProvisioningError, parse_users, provision_users
+from app.utils import stream_page
 
 bp = Blueprint("admin", __name__, url_prefix="/admin")
 
@@ -25,8 +27,20 @@ def dashboard(user_id: int):
         flash("User not found")
         return redirect(url_for("auth.logout"))
 
-    users = query_db("SELECT id, username, is_admin, created_at FROM users ORDER BY created_at DESC")
-    return render_template("admin_dashboard.html", user=current_user["username"], users=users)
+    page = keyset_page(
+        "SELECT id, username, is_admin, created_at, file_count, bytes_used FROM users LEFT JOIN user_usage ON user_usage.user_id = users.id",
+        "",
+        (),
+        {"name": "username", "date": "created_at"},
+        default_sort="date",
+    )
+    return stream_page(
+        "admin_dashboard.html",
+        user=current_user["username"],
+        users=page,
+        page=page,
+        jobs=recent_jobs(),
+    )
 
 
 @bp.route("/create_user", methods=["POST"])
@@ -41,8 +55,8 @@ def create_user(_):
         return redirect(url_for("admin.dashboard"))
 
     try:
-        password_hash = generate_password_hash(password)
-        query_db(
+        password_hash = hash_password(password)
+        write_db(
             "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
             (username, password_hash, is_admin),
         )
@@ -53,6 +67,27 @@ def create_user(_):
     return redirect(url_for("admin.dashboard"))
 
 
+@bp.route("/users/bulk", methods=["POST"])
+@auth_required(admin=True)
+def bulk_create_users(_):
+    """Create users from a JSON body, or CSV when sent as text/csv."""
+    fmt = "csv" if request.mimetype == "text/csv" else "json"
+    try:
+        records = parse_users(request.get_data(as_text=True), fmt)
+    except ProvisioningError as e:
+        return jsonify(error=str(e)), 400
+
+    try:
+        results = provision_users(records)
+    except HashPoolBusy:
+        response = make_response(jsonify(error="The server is busy. Please try again in a moment."), 503)
+        response.headers["Retry-After"] = "1"
+        return response
+
+    failed = sum(1 for result in results if "error" in result)
+    return jsonify(created=len(results) - failed, failed=failed, results=results)
+
+
 @bp.route("/delete_user/<int:user_id>", methods=["POST"])
 @auth_required(admin=True)
 def delete_user(current_user_id: int, user_id: int):
@@ -60,16 +95,42 @@ def delete_user(current_user_id: int, user_id: int):
         flash("Security alert: You cannot delete your own account.")
         return redirect(url_for("admin.dashboard"))
 
-    try:
-        files = query_db("SELECT file_path FROM files WHERE user_id = ?", (user_id,))
-        query_db("DELETE FROM users WHERE id = ?", (user_id,))
+    user = query_db("SELECT username FROM users WHERE id = ?", (user_id,), single=True)
+    if user is None:
+        flash("User not found")
+        return redirect(url_for("admin.dashboard"))
 
-        for file in files:
-            full_path: Path = Path(current_app.config["FILE_STORE"]) / file["file_path"]
-            full_path.unlink(missing_ok=True)
+    try:
+        with transaction(immediate=True):
+            uploads = query_db("SELECT id FROM upload_sessions WHERE user_id = ?", (user_id,))
+
+            # Unlinking a large account's files would outlast the request, so
+            # queue the paths for `flask run-worker` and only delete rows here.
+            job_id = enqueue(
+                "reclaim_files",
+                f"Clean up files of {user['username']}",
+                {"uploads": [upload["id"] for upload in uploads]},
+            )
+            write_db(
+                "INSERT INTO job_paths (job_id, path) SELECT DISTINCT ?, file_path FROM files WHERE user_id = ?",
+                (job_id, user_id),
+            )
+            write_db(
+                "UPDATE jobs SET total = (SELECT COUNT(*) FROM job_paths WHERE job_id = ?) WHERE id = ?",
+                (job_id, job_id),
+            )
+            write_db("DELETE FROM users WHERE id = ?", (user_id,))
 
         flash("User account removed.")
     except Exception as e:
         flash(f"Error: {str(e)}")
 
     return redirect(url_for("admin.dashboard"))
+
+
+@bp.route("/revoke_sessions/<int:user_id>", methods=["POST"])
+@auth_required(admin=True)
+def revoke_sessions(_, user_id: int):
+    revoke_refresh_tokens(user_id)
+    flash("The user's sessions will end when their current access token expires.")
+    return redirect(url_for("admin.dashboard"))
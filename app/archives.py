@@ -0,0 +1,209 @@
+"""Reading uploaded zip and tar archives, and streaming zip downloads."""
+
+import io
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from typing import NamedTuple
+
+from app.storage import open_stored
+from app.utils import format_size
+
+_TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Corrupt compressed data surfaces as any of these, often only mid-member.
+_READ_ERRORS = (
+    zipfile.BadZipFile,
+    zipfile.LargeZipFile,
+    tarfile.TarError,
+    zlib.error,
+    lzma.LZMAError,
+    EOFError,
+    NotImplementedError,
+    OSError,
+)
+
+
+# Formats that deflate would only spend CPU on.
+_COMPRESSED_SUFFIXES = frozenset(
+    (
+        ".7z", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jpeg",
+        ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg", ".png", ".pptx",
+        ".rar", ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".xlsx", ".xz", ".zip",
+        ".zst",
+    )
+)
+
+
+class ArchiveError(ValueError):
+    """Raised for archives that are corrupt or too large to unpack."""
+
+
+def is_archive(filename: str) -> bool:
+    name = filename.lower()
+    return name.endswith(".zip") or name.endswith(_TAR_SUFFIXES)
+
+
+def safe_member_name(name: str, fallback: str = "file") -> str:
+    """Return `name` as a relative path that cannot escape an extraction directory.
+
+    Empty, `.` and `..` segments are dropped; `fallback` is used if
+    nothing is left.
+    """
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return "/".join(parts) or fallback
+
+
+def _read(f, chunk_size: int) -> Iterator[bytes]:
+    try:
+        while chunk := f.read(chunk_size):
+            yield chunk
+    except _READ_ERRORS as e:
+        raise ArchiveError(f"Could not read archive: {e}") from e
+
+
+# Members smaller than this may compress as densely as they like.
+_RATIO_FLOOR = 1024 * 1024
+
+
+def iter_members(
+    path: str,
+    filename: str,
+    chunk_size: int,
+    max_members: int,
+    max_bytes: int | None = None,
+    max_ratio: float | None = None,
+) -> Iterator[tuple[str, Iterator[bytes]]]:
+    """Yield the name and content chunks of each regular file in an archive.
+
+    The format is chosen from `filename`. Each member's chunks must be
+    consumed before moving to the next member. Directories, links and
+    other special entries are skipped.
+
+    Reading raises `ArchiveError` once the members add up to more than
+    `max_bytes`, or expand to more than `max_ratio` times their compressed
+    size: per member for zip, and for the archive as a whole for tar, whose
+    compression spans members.
+    """
+    count = 0
+    expanded = 0
+    compressed_size = os.path.getsize(path)
+
+    def counted():
+        nonlocal count
+        count += 1
+        if count > max_members:
+            raise ArchiveError(f"Archive has more than {max_members} files.")
+
+    def capped(f, member_compressed_size: int | None) -> Iterator[bytes]:
+        nonlocal expanded
+        member = 0
+        for chunk in _read(f, chunk_size):
+            expanded += len(chunk)
+            member += len(chunk)
+            if max_bytes is not None and expanded > max_bytes:
+                raise ArchiveError(f"Archive expands to more than {format_size(max_bytes)}.")
+            if member_compressed_size is None:
+                size, limit = expanded, compressed_size
+            else:
+                size, limit = member, member_compressed_size
+            if max_ratio is not None and size > _RATIO_FLOOR and size > limit * max_ratio:
+                raise ArchiveError("Archive is compressed too densely to unpack safely.")
+            yield chunk
+
+    try:
+        if filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        continue
+                    counted()
+                    with archive.open(info) as f:
+                        yield safe_member_name(info.filename, f"file-{count}"), capped(f, info.compress_size)
+        else:
+            with tarfile.open(path) as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    counted()
+                    with archive.extractfile(member) as f:
+                        yield safe_member_name(member.name, f"file-{count}"), capped(f, None)
+    except _READ_ERRORS as e:
+        raise ArchiveError(f"Could not read archive: {e}") from e
+
+
+class ZipEntry(NamedTuple):
+    name: str
+    full_path: str
+    size_bytes: int
+    modified: datetime
+    codec: str | None = None
+
+
+class _Sink(io.RawIOBase):
+    """An unseekable file that collects writes until they are drained.
+
+    zipfile notices that it cannot seek and writes a data descriptor after
+    each member instead of going back to patch its header.
+    """
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self.size += len(b)
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def _unique(name: str, seen: set[str]) -> str:
+    stem, suffix = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in seen:
+        candidate = f"{stem} ({n}){suffix}"
+        n += 1
+    seen.add(candidate)
+    return candidate
+
+
+def stream_zip(entries: Iterable[ZipEntry], chunk_size: int) -> Iterator[bytes]:
+    """Yield a zip archive of `entries` as it is built.
+
+    Memory use is bounded by `chunk_size` however large the files are.
+    Files that are already compressed are stored rather than deflated.
+    """
+    sink = _Sink()
+    seen: set[str] = set()
+
+    with zipfile.ZipFile(sink, "w") as archive:
+        for entry in entries:
+            info = zipfile.ZipInfo(_unique(safe_member_name(entry.name), seen), entry.modified.timetuple()[:6])
+            info.external_attr = 0o644 << 16
+            # Declaring the size up front lets zipfile choose Zip64 headers.
+            info.file_size = entry.size_bytes
+            suffix = os.path.splitext(entry.name)[1].lower()
+            info.compress_type = (
+                zipfile.ZIP_STORED if suffix in _COMPRESSED_SUFFIXES else zipfile.ZIP_DEFLATED
+            )
+
+            with open_stored(entry.full_path, entry.codec) as src, archive.open(info, "w") as dest:
+                while chunk := src.read(chunk_size):
+                    dest.write(chunk)
+                    if sink.size >= chunk_size:
+                        yield sink.drain()
+
+    yield sink.drain()
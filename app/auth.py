@@ -1,20 +1,27 @@
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 from functools import wraps
+from typing import NamedTuple
 
 import jwt
 from flask import (
     Blueprint,
+    Response,
     current_app,
     flash,
+    g,
     make_response,
     redirect,
     render_template,
     request,
     url_for,
 )
-from werkzeug.security import check_password_hash
-
-from app.db import query_db
+from app.db import query_db, transaction, write_db
+from app.passwords import HashPoolBusy, verify_password
 
 bp = Blueprint("auth", __name__)
 
@@ -34,22 +41,24 @@ def login():
 
     user = query_db("SELECT * FROM users WHERE username = ?", (username,), single=True)
 
-    if user and check_password_hash(user["password_hash"], password):
-        user_role = "admin" if user["is_admin"] == 1 else "user"
-
-        payload = {
-            "sub": f"{user['id']}",
-            "username": username,
-            "role": user_role,
-            "exp": datetime.now(timezone.utc) + timedelta(hours=2),
-        }
+    try:
+        verified = user is not None and verify_password(user["password_hash"], password)
+    except HashPoolBusy:
+        flash("The server is busy. Please try again in a moment.")
+        response = make_response(render_template("login.html"), 503)
+        response.headers["Retry-After"] = "1"
+        return response
 
-        token = jwt.encode(payload, current_app.config["SECRET_KEY"], algorithm="HS256")
+    if verified:
+        identity = Identity(user["id"], username, "admin" if user["is_admin"] == 1 else "user")
 
         # Determine where to send the user
-        target = "admin.dashboard" if user_role == "admin" else "files.view"
+        target = "admin.dashboard" if identity.role == "admin" else "files.view"
         response = make_response(redirect(url_for(target)))
-        response.set_cookie("access_token", token, httponly=True, samesite="Lax")
+        response.set_cookie(
+            "access_token", issue_access_token(identity), httponly=True, samesite="Lax"
+        )
+        _set_refresh_cookie(response, issue_refresh_token(identity.user_id))
         return response
 
     flash("Invalid username or password")
@@ -58,12 +67,293 @@ def login():
 
 @bp.route("/logout")
 def logout():
+    refresh_token = request.cookies.get("refresh_token")
+    if refresh_token:
+        write_db("DELETE FROM refresh_tokens WHERE token_hash = ?", (_token_hash(refresh_token),))
+
+    access_token = request.cookies.get("access_token")
+    if access_token:
+        try:
+            revoke_access_token(decode_token(access_token))
+        except jwt.InvalidTokenError:
+            pass  # Already expired or never valid; nothing to revoke.
+
     response = make_response(redirect(url_for("auth.login")))
     response.delete_cookie("access_token")
+    response.delete_cookie("refresh_token")
     flash("You have been logged out.")
     return response
 
 
+class Identity(NamedTuple):
+    user_id: int
+    username: str
+    role: str
+
+
+def issue_access_token(identity: Identity) -> str:
+    payload = {
+        "sub": f"{identity.user_id}",
+        "username": identity.username,
+        "role": identity.role,
+        "jti": secrets.token_urlsafe(16),
+        "exp": datetime.now(timezone.utc)
+        + timedelta(seconds=current_app.config["ACCESS_TOKEN_LIFETIME"]),
+    }
+    return jwt.encode(payload, current_app.config["SECRET_KEY"], algorithm="HS256")
+
+
+def _token_hash(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def issue_refresh_token(user_id: int) -> str:
+    """Create a refresh token; only its SHA-256 digest is stored."""
+    token = secrets.token_urlsafe(32)
+    now = int(time.time())
+    with transaction():
+        write_db("DELETE FROM refresh_tokens WHERE expires_at <= ?", (now,))
+        write_db(
+            "INSERT INTO refresh_tokens (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+            (_token_hash(token), user_id, now, now + current_app.config["REFRESH_TOKEN_LIFETIME"]),
+        )
+    return token
+
+
+def _set_refresh_cookie(response: Response, token: str):
+    response.set_cookie(
+        "refresh_token",
+        token,
+        max_age=current_app.config["REFRESH_TOKEN_LIFETIME"],
+        httponly=True,
+        samesite="Lax",
+    )
+
+
+def refresh_identity(token: str) -> Identity | None:
+    """Redeem a refresh token, sliding its expiry forward.
+
+    Returns None if the token is unknown, revoked, idle for longer than
+    REFRESH_TOKEN_LIFETIME, or older than REFRESH_TOKEN_MAX_LIFETIME.
+    """
+    now = int(time.time())
+    row = write_db(
+        """
+        UPDATE refresh_tokens
+        SET expires_at = min(?, created_at + ?)
+        WHERE token_hash = ? AND expires_at > ?
+        RETURNING user_id
+        """,
+        (
+            now + current_app.config["REFRESH_TOKEN_LIFETIME"],
+            current_app.config["REFRESH_TOKEN_MAX_LIFETIME"],
+            _token_hash(token),
+            now,
+        ),
+        single=True,
+    )
+    if row is None:
+        return None
+
+    # Read the role afresh, so a demoted admin loses access at renewal.
+    user = query_db(
+        "SELECT id, username, is_admin FROM users WHERE id = ?", (row["user_id"],), single=True
+    )
+    if user is None:
+        return None
+    return Identity(user["id"], user["username"], "admin" if user["is_admin"] == 1 else "user")
+
+
+def revoke_refresh_tokens(user_id: int):
+    """Sign a user out everywhere once their current access tokens expire."""
+    write_db("DELETE FROM refresh_tokens WHERE user_id = ?", (user_id,))
+
+
+class TokenCache:
+    """LRU cache of verified JWT claims, keyed by a digest of the token.
+
+    Entries are dropped once their `exp` passes, so a hit never extends a
+    token's lifetime; a hit only skips the signature check.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._key(token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+            if claims["exp"] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token: str, claims: dict):
+        if self.max_size <= 0 or "exp" not in claims:
+            return
+
+        with self._lock:
+            self._entries[self._key(token)] = claims
+            if len(self._entries) > self.max_size:
+                now = time.time()
+                for key in [k for k, v in self._entries.items() if v["exp"] <= now]:
+                    del self._entries[key]
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class RevocationList:
+    """A worker's mirror of the `revoked_tokens` table.
+
+    Checks are set lookups with no I/O. The mirror pulls only the rows
+    added since its last sync, at most once per `sync_interval` seconds,
+    so a revocation made by another worker applies within one interval.
+    Entries are dropped once their token would have expired anyway.
+    """
+
+    def __init__(self, sync_interval: float):
+        self.sync_interval = sync_interval
+        self._expiry: dict[str, float] = {}
+        self._last_id = 0
+        self._synced_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def add(self, jti: str, exp: float):
+        with self._lock:
+            self._expiry[jti] = exp
+
+    def sync(self):
+        rows = query_db(
+            "SELECT id, jti, expires_at FROM revoked_tokens WHERE id > ? ORDER BY id",
+            (self._last_id,),
+        )
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                self._expiry[row["jti"]] = row["expires_at"]
+            if rows:
+                self._last_id = rows[-1]["id"]
+            for jti in [jti for jti, exp in self._expiry.items() if exp <= now]:
+                del self._expiry[jti]
+            self._synced_at = time.monotonic()
+
+    def is_revoked(self, jti: str) -> bool:
+        if time.monotonic() - self._synced_at >= self.sync_interval:
+            self.sync()
+        return jti in self._expiry
+
+
+# Guards the lazy creation of the per-worker caches below, which request
+# threads of a gthread worker can otherwise race to build twice.
+_extensions_lock = threading.Lock()
+
+
+def get_revocation_list() -> RevocationList:
+    revoked: RevocationList | None = current_app.extensions.get("revocation_list")
+    if revoked is None:
+        with _extensions_lock:
+            revoked = current_app.extensions.get("revocation_list")
+            if revoked is None:
+                revoked = RevocationList(current_app.config["REVOCATION_SYNC_INTERVAL"])
+                current_app.extensions["revocation_list"] = revoked
+    return revoked
+
+
+def revoke_access_token(claims: dict):
+    """Reject an access token from now on, even before its `exp`."""
+    jti = claims.get("jti")
+    if jti is None:
+        return  # Minted before tokens carried an id.
+
+    with transaction():
+        # Compact as we go: expired tokens fail verification by themselves.
+        write_db("DELETE FROM revoked_tokens WHERE expires_at <= ?", (int(time.time()),))
+        write_db(
+            "INSERT INTO revoked_tokens (jti, expires_at) VALUES (?, ?) ON CONFLICT (jti) DO NOTHING",
+            (jti, int(claims["exp"])),
+        )
+    get_revocation_list().add(jti, claims["exp"])
+
+
+def decode_token(token: str) -> dict:
+    """Verify an access token, skipping the HMAC check for cached tokens."""
+    cache: TokenCache | None = current_app.extensions.get("token_cache")
+    if cache is None:
+        with _extensions_lock:
+            cache = current_app.extensions.get("token_cache")
+            if cache is None:
+                cache = TokenCache(current_app.config["TOKEN_CACHE_SIZE"])
+                current_app.extensions["token_cache"] = cache
+
+    claims = cache.get(token)
+    if claims is None:
+        claims = jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
+        cache.put(token, claims)
+    return claims
+
+
+@bp.before_app_request
+def reset_identity():
+    # g outlives a single request when an app context is pushed around
+    # several of them (CLI commands, tests), so start each one fresh.
+    g.pop("identity", None)
+    g.pop("renewed_token", None)
+
+
+def resolve_identity(refresh: bool = True) -> Identity | None:
+    """Return who made the current request, decoding the token at most once.
+
+    With `refresh`, an expired access token is renewed from the refresh
+    token cookie.
+    """
+    if "identity" not in g:
+        g.identity = None
+        token = request.cookies.get("access_token")
+
+        if token:
+            try:
+                data = decode_token(token)
+                if "jti" in data and get_revocation_list().is_revoked(data["jti"]):
+                    data = {}
+                if data.get("sub") is not None:
+                    g.identity = Identity(
+                        int(data["sub"]), data.get("username", "unknown"), data.get("role")
+                    )
+            except jwt.ExpiredSignatureError:
+                pass  # The usual case; renewed from the refresh token below.
+            except Exception as e:
+                # Invalid signatures, malformed tokens and the like.
+                current_app.logger.warning("Rejected access token: %s", e)
+
+        refresh_token = request.cookies.get("refresh_token")
+        if g.identity is None and refresh and refresh_token:
+            # The access token lapsed: renew it without asking for the
+            # password again. `renew_tokens` sends the new cookies.
+            g.identity = refresh_identity(refresh_token)
+            if g.identity is not None:
+                g.renewed_token = issue_access_token(g.identity)
+
+    return g.identity
+
+
+@bp.after_app_request
+def renew_tokens(response: Response) -> Response:
+    token = g.pop("renewed_token", None)
+    if token is not None:
+        response.set_cookie("access_token", token, httponly=True, samesite="Lax")
+        _set_refresh_cookie(response, request.cookies["refresh_token"])
+    return response
+
+
 def auth_required(*, admin=False):
     """
     If admin=True, it checks for the 'admin' role in the JWT payload.
@@ -72,34 +362,19 @@ def auth_required(*, admin=False):
     def decorator(f):
         @wraps(f)
         def decorated(*args, **kwargs):
-            token = request.cookies.get("access_token")
+            identity = resolve_identity()
 
-            if not token:
+            if identity is None:
                 return redirect(url_for("auth.login"))
 
-            try:
-                # Verify signature and expiration
-                data = jwt.decode(
-                    token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
-                )
-
-                # Role check logic
-                if admin and data.get("role") != "admin":
-                    print("Access denied: Admins only.")
-                    flash("Access denied: Admins only.")
-                    return redirect(url_for("auth.login"))
-
-                sub = data.get("sub")
-                if sub is None:
-                    flash("Invalid access token.")
-                    return redirect(url_for("auth.login"))
-
-                return f(int(sub), *args, **kwargs)
-            except Exception as e:
-                print(e)
-                # Catches expired tokens or invalid signatures
+            # Role check logic
+            if admin and identity.role != "admin":
+                print("Access denied: Admins only.")
+                flash("Access denied: Admins only.")
                 return redirect(url_for("auth.login"))
 
+            return f(identity.user_id, *args, **kwargs)
+
         return decorated
 
     return decorator
@@ -0,0 +1,60 @@
+"""Codecs for compressing the file store at rest.
+
+gzip is always available. zstd needs the optional `zstandard` package.
+Both names match their HTTP content-coding tokens, so stored bytes can be
+sent as-is with a `Content-Encoding` header.
+"""
+
+import gzip
+import zlib
+from typing import BinaryIO, Protocol
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+CODECS = ("gzip", "zstd")
+
+# How much of a file is trial-compressed to decide whether to compress it,
+# and the ratio the trial must beat.
+SAMPLE_SIZE = 64 * 1024
+MIN_RATIO = 0.9
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+def check_codec(codec: str | None):
+    """Raise ValueError if `codec` cannot be used on this installation."""
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise ValueError(f"Unknown compression codec {codec!r}; expected one of {CODECS}")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("The zstd codec needs the zstandard package installed")
+
+
+def worth_compressing(sample: bytes) -> bool:
+    """Whether a fast trial compression of `sample` saves enough space."""
+    return bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * MIN_RATIO
+
+
+def compressor(codec: str, level: int | None = None) -> Compressor:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    # wbits 31 writes a gzip header and trailer rather than a bare zlib stream.
+    return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+
+
+def open_decompressed(path: str, codec: str) -> BinaryIO:
+    """Open a stored file for reading its original content.
+
+    The result supports forward `seek`, which decompresses and discards.
+    """
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return gzip.open(path, "rb")
@@ -1,4 +1,11 @@
+import os
+import queue
 import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Literal, overload
 
@@ -6,14 +13,354 @@ import click
 from flask import Flask, current_app, g
 from werkzeug.security import generate_password_hash
 
+from app.observability import record_query
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became available in time."""
+
+
+def _pragmas_from_config(config) -> dict[str, str | int]:
+    """Collect the tuning pragmas applied to every new connection."""
+    pragmas: dict[str, str | int] = {
+        "busy_timeout": int(config["DATABASE_BUSY_TIMEOUT"]),
+        "cache_size": int(config["DATABASE_CACHE_SIZE"]),
+        "mmap_size": int(config["DATABASE_MMAP_SIZE"]),
+    }
+
+    for name, key in (
+        ("journal_mode", "DATABASE_JOURNAL_MODE"),
+        ("synchronous", "DATABASE_SYNCHRONOUS"),
+    ):
+        value = str(config[key])
+        if not value.isalpha():
+            raise ValueError(f"Invalid value for {key}: {value!r}")
+        pragmas[name] = value.upper()
+
+    return pragmas
+
+
+def connect(
+    database: str, pragmas: dict[str, str | int], **kwargs
+) -> sqlite3.Connection:
+    db = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+        **kwargs,
+    )
+    # busy_timeout first so switching the journal mode can wait for a lock.
+    for name in sorted(pragmas, key=lambda name: name != "busy_timeout"):
+        db.execute(f"PRAGMA {name} = {pragmas[name]}").close()
+    db.execute("PRAGMA foreign_keys = ON")
+    db.row_factory = sqlite3.Row
+    return db
+
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of SQLite connections.
+
+    Each worker process owns one pool (see `get_pool`). Connections are
+    checked out for the lifetime of an app context and handed back in
+    teardown, so requests no longer pay for connect and pragma setup.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        size: int = 5,
+        timeout: float = 30.0,
+        pragmas: dict[str, str | int] | None = None,
+    ):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas or {}
+        self.pid = os.getpid()
+
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._open = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "misses": 0,
+            "timeouts": 0,
+            "invalidated": 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect(self.database, self.pragmas)
+
+    @staticmethod
+    def _is_healthy(db: sqlite3.Connection) -> bool:
+        try:
+            db.execute("SELECT 1").close()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, db: sqlite3.Connection):
+        with self._lock:
+            self._open -= 1
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+    def acquire(self) -> sqlite3.Connection:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._stats["timeouts"] += 1
+                raise PoolTimeout(
+                    f"No database connection available after {self.timeout}s"
+                )
+
+        try:
+            while True:
+                try:
+                    db = self._idle.get_nowait()
+                except queue.Empty:
+                    db = self._connect()
+                    with self._lock:
+                        self._open += 1
+                        self._stats["misses"] += 1
+                    break
+
+                if self._is_healthy(db):
+                    break
+
+                with self._lock:
+                    self._stats["invalidated"] += 1
+                self._discard(db)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+        return db
+
+    def release(self, db: sqlite3.Connection):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            with self._lock:
+                self._stats["invalidated"] += 1
+            self._discard(db)
+        else:
+            self._idle.put(db)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                **self._stats,
+                "size": self.size,
+                "open": self._open,
+                "idle": self._idle.qsize(),
+            }
+
+
+class _Write:
+    __slots__ = ("query", "args", "future")
+
+    def __init__(self, query: str, args: tuple | None):
+        self.query = query
+        self.args = args
+        self.future: Future[list[sqlite3.Row]] = Future()
+
+
+class WriteQueue:
+    """Funnels writes through one connection and commits them in groups.
+
+    Threads submitting INSERT/DELETE statements block until the writer
+    thread has committed the batch their statement landed in. Every
+    statement runs under its own savepoint, so one failing statement
+    only fails its own caller.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        pragmas: dict[str, str | int] | None = None,
+        batch_size: int = 64,
+    ):
+        self.database = database
+        self.pragmas = pragmas or {}
+        self.batch_size = batch_size
+        self.pid = os.getpid()
+
+        self._pending: queue.Queue[_Write | None] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stats = {"statements": 0, "commits": 0}
+
+    def submit(self, query: str, args: tuple | None = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sqlite-writer", daemon=True
+                )
+                self._thread.start()
+
+            # Queue under the lock so a dying writer cannot miss this write.
+            write = _Write(query, args)
+            self._pending.put(write)
+        return write.future.result()
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None:
+                self._pending.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {**self._stats, "pending": self._pending.qsize()}
+
+    def _run(self):
+        batch: list[_Write] = []
+
+        try:
+            db = connect(self.database, self.pragmas, isolation_level=None)
+            try:
+                while True:
+                    write = self._pending.get()
+                    if write is None:
+                        return
+
+                    batch = [write]
+                    while len(batch) < self.batch_size:
+                        try:
+                            write = self._pending.get_nowait()
+                        except queue.Empty:
+                            break
+                        if write is None:
+                            self._pending.put(None)
+                            break
+                        batch.append(write)
+
+                    self._commit(db, batch)
+                    batch = []
+            finally:
+                db.close()
+        except BaseException as e:
+            # Fail everyone waiting, and let the next submit() start over
+            # with a fresh writer instead of blocking forever.
+            with self._lock:
+                self._thread = None
+                while True:
+                    try:
+                        write = self._pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if write is not None:
+                        batch.append(write)
+            for write in batch:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            raise
+
+    def _commit(self, db: sqlite3.Connection, batch: list[_Write]):
+        results: list[list[sqlite3.Row] | Exception] = []
+
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for write in batch:
+                db.execute("SAVEPOINT write")
+                try:
+                    cur = db.execute(write.query, write.args)
+                    results.append(cur.fetchall())
+                    cur.close()
+                except Exception as e:
+                    # Binding errors (OverflowError, TypeError, ...) are
+                    # the caller's problem too, not the writer's.
+                    db.execute("ROLLBACK TO write")
+                    results.append(e)
+                db.execute("RELEASE write")
+            db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            for write in batch:
+                write.future.set_exception(e)
+            return
+
+        with self._lock:
+            self._stats["statements"] += len(batch)
+            self._stats["commits"] += 1
+
+        for write, result in zip(batch, results):
+            if isinstance(result, Exception):
+                write.future.set_exception(result)
+            else:
+                write.future.set_result(result)
+
+
+# Guards the lazy creation of the per-worker objects below, which request
+# threads of a gthread worker can otherwise race to build twice.
+_extensions_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Return this worker's pool, rebuilding it if we were forked."""
+    pool: ConnectionPool | None = current_app.extensions.get("db_pool")
+
+    if pool is None or pool.pid != os.getpid():
+        with _extensions_lock:
+            pool = current_app.extensions.get("db_pool")
+            if pool is None or pool.pid != os.getpid():
+                pool = ConnectionPool(
+                    current_app.config["DATABASE"],
+                    size=current_app.config["DATABASE_POOL_SIZE"],
+                    timeout=current_app.config["DATABASE_POOL_TIMEOUT"],
+                    pragmas=_pragmas_from_config(current_app.config),
+                )
+                current_app.extensions["db_pool"] = pool
+
+    return pool
+
+
+def get_write_queue() -> WriteQueue:
+    """Return this worker's write queue, rebuilding it if we were forked."""
+    writes: WriteQueue | None = current_app.extensions.get("db_write_queue")
+
+    if writes is None or writes.pid != os.getpid():
+        with _extensions_lock:
+            writes = current_app.extensions.get("db_write_queue")
+            if writes is None or writes.pid != os.getpid():
+                writes = WriteQueue(
+                    current_app.config["DATABASE"],
+                    pragmas=_pragmas_from_config(current_app.config),
+                    batch_size=current_app.config["DATABASE_WRITE_BATCH_SIZE"],
+                )
+                current_app.extensions["db_write_queue"] = writes
+
+    return writes
+
 
 def get_db() -> sqlite3.Connection:
     if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.execute("PRAGMA foreign_keys = ON")
-        g.db.row_factory = sqlite3.Row
+        # Remember the pool: the connection goes back to it even if the
+        # worker's pool has been replaced in the meantime.
+        g.db_pool = get_pool()
+        g.db = g.db_pool.acquire()
 
     return g.db
 
@@ -31,33 +378,201 @@ def query_db(
 
 
 def query_db(query: str, args: tuple | None = (), single: bool = False):
-    cur = get_db().execute(query, args)
+    """Run a query on the request's connection and return its rows.
+
+    SELECTs never open a transaction, so reads go straight through without
+    a commit. A data-modifying statement issued outside `transaction()` is
+    still committed immediately; prefer `write_db` for those.
+    """
+    started = time.perf_counter()
+    db = get_db()
+    cur = db.execute(query, args)
     rv = cur.fetchall()
     cur.close()
-    get_db().commit()
+    if db.in_transaction and not g.get("db_transaction"):
+        db.commit()
+    record_query(_statement_kind(query), time.perf_counter() - started)
+    return (rv[0] if rv else None) if single else rv
+
+
+def _open_cursor(query: str, args: tuple | None) -> sqlite3.Cursor:
+    started = time.perf_counter()
+    cur = get_db().execute(query, args)
+    # Closed in close_db if the caller abandons the iterator, so no open
+    # statement (and its read snapshot) goes back into the pool.
+    g.setdefault("db_cursors", []).append(cur)
+    record_query(_statement_kind(query), time.perf_counter() - started)
+    return cur
+
+
+def iter_db(query: str, args: tuple | None = ()) -> Iterator[sqlite3.Row]:
+    """Yield a query's rows one at a time as SQLite produces them.
+
+    The cursor stays open until the iterator is exhausted or closed, or the
+    request ends. Statements that modify data must run inside
+    `transaction()`, as they are not committed here.
+    """
+    cur = _open_cursor(query, args)
+    try:
+        yield from cur
+    finally:
+        cur.close()
+
+
+def batch_db(
+    query: str, args: tuple | None = (), size: int | None = None
+) -> Iterator[list[sqlite3.Row]]:
+    """Like `iter_db`, but yield lists of up to `size` rows via `fetchmany`.
+
+    `size` defaults to DATABASE_FETCH_SIZE.
+    """
+    size = size or current_app.config["DATABASE_FETCH_SIZE"]
+    cur = _open_cursor(query, args)
+    try:
+        while rows := cur.fetchmany(size):
+            yield rows
+    finally:
+        cur.close()
+
+
+def _statement_kind(query: str) -> str:
+    keyword = query.lstrip()[:6].upper()
+    return "read" if keyword in ("SELECT", "PRAGMA") else "write"
+
+
+@contextmanager
+def transaction(immediate: bool = False) -> Iterator[sqlite3.Connection]:
+    """Group several statements into one transaction on the request's connection.
+
+    Commits when the block exits and rolls back if it raises. Nested blocks
+    join the outermost transaction. `immediate=True` takes the write lock
+    up front instead of on the first write.
+    """
+    db = get_db()
+
+    if g.get("db_transaction"):
+        yield db
+        return
+
+    db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    g.db_transaction = True
+    g.db_commit_hooks = []
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        # Undo side effects while we still hold the write lock.
+        for _, undo in reversed(g.db_commit_hooks):
+            if undo is not None:
+                undo()
+        db.rollback()
+        raise
+    finally:
+        g.db_transaction = False
+        hooks = g.pop("db_commit_hooks")
+
+    for callback, _ in hooks:
+        callback()
+
+
+def on_commit(callback: Callable[[], object], undo: Callable[[], object] | None = None):
+    """Run `callback` once the current transaction has committed.
+
+    For side effects outside the database, such as removing files, that
+    must not happen if the transaction rolls back. `undo` runs instead on
+    rollback. Outside a transaction, `callback` runs at once.
+    """
+    if g.get("db_transaction"):
+        g.db_commit_hooks.append((callback, undo))
+    else:
+        callback()
+
+
+@overload
+def write_db(
+    query: str, args: tuple | None = (), *, single: Literal[True]
+) -> sqlite3.Row | None: ...
+
+
+@overload
+def write_db(
+    query: str, args: tuple | None = (), single: Literal[False] = False
+) -> list[sqlite3.Row]: ...
+
+
+def write_db(query: str, args: tuple | None = (), single: bool = False):
+    """Run a single INSERT/UPDATE/DELETE and commit it.
+
+    With DATABASE_WRITE_QUEUE enabled the statement is handed to the
+    worker's write queue and group-committed with concurrent writes. Inside
+    `transaction()` it always runs on the request's connection.
+    """
+    if current_app.config["DATABASE_WRITE_QUEUE"] and not g.get("db_transaction"):
+        started = time.perf_counter()
+        rv = get_write_queue().submit(query, args)
+        record_query("write", time.perf_counter() - started)
+    else:
+        rv = query_db(query, args)
     return (rv[0] if rv else None) if single else rv
 
 
 def close_db(_):
+    for cur in g.pop("db_cursors", ()):
+        cur.close()
+
     db: sqlite3.Connection | None = g.pop("db", None)
+    pool: ConnectionPool | None = g.pop("db_pool", None)
 
-    if db is not None:
-        db.close()
+    if db is not None and pool is not None:
+        pool.release(db)
 
 
-def init_db():
-    """Initialize the database with the schema and default admin user."""
+# Columns added to tables that existed before the schema grew them, as
+# (table, column, definition). `migrate_db` adds whichever are missing.
+_ADDED_COLUMNS = [
+    ("files", "checksum", "TEXT"),
+]
+
+
+def migrate_db():
+    """Bring the schema up to date. Safe to run on every start.
+
+    Creates missing tables, indexes and triggers, adds missing columns and
+    fills in `user_usage` for users created before it existed.
+    """
     db = get_db()
 
     with current_app.open_resource("schema.sql") as f:
         db.executescript(f.read().decode("utf8"))
 
-        password_hash = generate_password_hash("password")
+    with transaction(immediate=True):
+        for table, column, definition in _ADDED_COLUMNS:
+            columns = {row["name"] for row in db.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+        # The triggers keep this current from here on.
         db.execute(
+            """
+            INSERT INTO user_usage (user_id, file_count, bytes_used)
+            SELECT users.id, COUNT(files.id), COALESCE(SUM(files.size_bytes), 0)
+            FROM users LEFT JOIN files ON files.user_id = users.id
+            WHERE users.id NOT IN (SELECT user_id FROM user_usage)
+            GROUP BY users.id
+            """
+        )
+
+
+def init_db():
+    """Initialize the database with the schema and default admin user."""
+    migrate_db()
+
+    # Only on first setup: never recreate an admin that was removed.
+    if query_db("SELECT 1 FROM users LIMIT 1", single=True) is None:
+        write_db(
             "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
-            ("default admin", password_hash, 1),
+            ("default admin", generate_password_hash("password"), 1),
         )
-        db.commit()
 
 
 @click.command("init-db")
@@ -67,9 +582,17 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("migrate-db")
+def migrate_db_command():
+    """Create missing tables and columns in an existing database."""
+    migrate_db()
+    click.echo("Migrated the database.")
+
+
 sqlite3.register_converter("timestamp", lambda v: datetime.fromisoformat(v.decode()))
 
 
 def init_app(app: Flask):
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
@@ -0,0 +1,216 @@
+"""Serving stored files with byte-range and conditional request support."""
+
+import mimetypes
+import os
+import secrets
+import unicodedata
+from collections.abc import Callable, Iterator
+from typing import BinaryIO
+from urllib.parse import quote
+
+from flask import Response, current_app, request
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import ClosingIterator, FileWrapper, wrap_file
+
+from app.storage import open_stored
+
+
+def _content_disposition(download_name: str) -> dict[str, str]:
+    try:
+        download_name.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        return {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    return {"filename": download_name}
+
+
+def _read_span(f: BinaryIO, start: int, length: int, chunk_size: int) -> Iterator[bytes]:
+    f.seek(start)
+    while length > 0:
+        chunk = f.read(min(chunk_size, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+
+def _requested_spans(size: int) -> list[tuple[int, int]] | None:
+    """Resolve the request's Range header into (start, stop) spans.
+
+    Returns None when the whole file should be sent: no usable Range
+    header, a non-matching If-Range, or more ranges than we serve.
+    An empty list means none of the ranges can be satisfied.
+    """
+    ranges = request.range
+    if ranges is None or ranges.units != "bytes":
+        return None
+    if len(ranges.ranges) > current_app.config["DOWNLOAD_MAX_RANGES"]:
+        return None
+
+    spans = []
+    for start, stop in ranges.ranges:
+        if start < 0:
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            spans.append((start, stop))
+    return spans
+
+
+def _if_range_matches(etag: str, last_modified: float) -> bool:
+    header = request.headers.get("If-Range")
+    if header is None:
+        return True
+    if header.startswith("W/"):
+        return False
+
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    return if_range.date is not None and if_range.date.timestamp() == int(last_modified)
+
+
+def call_on_body_close(response: Response, callback: Callable[[], object]):
+    """Run `callback` once the server closes the body of `response`.
+
+    `Response.call_on_close` never fires for `direct_passthrough` bodies,
+    which go to the server as they are. A file wrapper keeps its type, so
+    gunicorn still sends it with sendfile.
+    """
+    body = response.response
+    if isinstance(body, request.environ.get("wsgi.file_wrapper", FileWrapper)):
+        close = getattr(body, "close", None)
+
+        def closing():
+            try:
+                if close is not None:
+                    close()
+            finally:
+                callback()
+
+        body.close = closing
+    else:
+        response.response = ClosingIterator(body, callback)
+
+
+def _accepts_encoding(codec: str) -> bool:
+    return request.range is None and request.accept_encodings[codec] > 0
+
+
+def send_stored_file(
+    full_path: str,
+    download_name: str,
+    etag: str,
+    codec: str | None = None,
+    size: int | None = None,
+) -> Response:
+    """Send `full_path` as an attachment, honouring Range and validators.
+
+    `etag` must be a strong validator for the content, e.g. its digest.
+    Full and single-range bodies go out through the server's
+    `wsgi.file_wrapper`, which gunicorn turns into `sendfile`.
+
+    A file stored with `codec` is sent as stored with `Content-Encoding`
+    when the client accepts that coding and wants the whole file;
+    otherwise it is decompressed on the fly. `size` is then the
+    original size.
+    """
+    stat = os.stat(full_path)
+    mimetype = mimetypes.guess_type(download_name)[0] or "application/octet-stream"
+    chunk_size = current_app.config["UPLOAD_CHUNK_SIZE"]
+
+    headers = Headers()
+    headers.set("Content-Disposition", "attachment", **_content_disposition(download_name))
+    headers["Accept-Ranges"] = "bytes"
+
+    encoded = codec is not None and _accepts_encoding(codec)
+    if codec is not None:
+        headers["Vary"] = "Accept-Encoding"
+    if encoded:
+        # A different representation of the same content needs its own tag.
+        etag = f"{etag}-{codec}"
+        headers["Content-Encoding"] = codec
+    if codec is None or encoded:
+        size = stat.st_size
+
+    response = current_app.response_class(headers=headers, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = stat.st_mtime
+
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        return response
+
+    decompress = codec is not None and not encoded
+    spans = None
+    if _if_range_matches(etag, stat.st_mtime):
+        spans = _requested_spans(size)
+        # Decompressing readers cannot seek backwards cheaply, so only a
+        # single range is served from compressed content.
+        if decompress and spans and len(spans) > 1:
+            spans = None
+
+    if spans == []:
+        response.status_code = 416
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+
+    f = open_stored(full_path, codec if decompress else None)
+    response.direct_passthrough = True
+
+    if spans is None:
+        # sendfile would copy the compressed bytes, so decompressed
+        # bodies are read through the codec instead.
+        if decompress:
+            response.response = _read_span(f, 0, size, chunk_size)
+        else:
+            response.response = wrap_file(request.environ, f, chunk_size)
+        response.content_length = size
+        call_on_body_close(response, f.close)
+        return response
+
+    response.status_code = 206
+
+    if len(spans) == 1:
+        start, stop = spans[0]
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.content_length = stop - start
+
+        # gunicorn's sendfile starts at the current offset and stops after
+        # Content-Length bytes; other servers' wrappers read to EOF.
+        if not decompress and request.environ.get("SERVER_SOFTWARE", "").startswith("gunicorn"):
+            f.seek(start)
+            response.response = wrap_file(request.environ, f, chunk_size)
+        else:
+            response.response = _read_span(f, start, stop - start, chunk_size)
+        call_on_body_close(response, f.close)
+        return response
+
+    boundary = secrets.token_hex(16)
+    parts = [
+        (
+            f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode("latin-1")
+        for start, stop in spans
+    ]
+    closing = f"--{boundary}--\r\n".encode("latin-1")
+
+    def generate() -> Iterator[bytes]:
+        for part, (start, stop) in zip(parts, spans):
+            yield part
+            yield from _read_span(f, start, stop - start, chunk_size)
+            yield b"\r\n"
+        yield closing
+
+    response.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    response.content_length = (
+        sum(len(part) + stop - start + 2 for part, (start, stop) in zip(parts, spans))
+        + len(closing)
+    )
+    response.response = generate()
+    call_on_body_close(response, f.close)
+    return response
@@ -1,20 +1,51 @@
-from flask import send_from_directory
-import secrets
+import json
 import os
+import time
+from collections.abc import Iterable, Iterator
+from datetime import datetime
 
 from flask import (
     Blueprint,
+    abort,
     current_app,
     flash,
+    jsonify,
     redirect,
-    render_template,
     request,
+    stream_with_context,
     url_for,
 )
-from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 
+from app.archives import (
+    ArchiveError,
+    ZipEntry,
+    is_archive,
+    iter_members,
+    safe_member_name,
+    stream_zip,
+)
 from app.auth import auth_required
-from app.db import query_db
+from app.db import query_db, transaction, write_db
+from app.downloads import call_on_body_close, send_stored_file
+from app.multipart import iter_multipart
+from app.observability import get_metrics, record_transfer
+from app.pagination import keyset_page
+from app.storage import (
+    QuotaExceeded,
+    StoredFile,
+    UploadTooLarge,
+    check_quota,
+    checksum_file,
+    commit_blob,
+    compress_received,
+    discard_received,
+    get_usage,
+    receive_chunks,
+    release_file,
+    remaining_quota,
+)
+from app.utils import format_size, stream_page
 
 bp = Blueprint("files", __name__, url_prefix="/dashboard")
 
@@ -22,47 +53,193 @@ bp = Blueprint("files", __name__, url_prefix="/dashboard")
 @bp.route("/")
 @auth_required()
 def view(user_id: int):
-    files = query_db("SELECT * FROM files WHERE user_id = ?", (user_id,))
+    page = keyset_page(
+        "SELECT * FROM files",
+        "user_id = ?",
+        (user_id,),
+        {"name": "display_name", "size": "size_bytes", "date": "uploaded_at"},
+        default_sort="date",
+    )
     user = query_db("SELECT is_admin FROM users WHERE id = ?", (user_id,), single=True)
     is_admin = user["is_admin"] == 1 if user else False
-    return render_template("user_dashboard.html", files=files, is_admin=is_admin)
+    return stream_page(
+        "user_dashboard.html",
+        files=page,
+        page=page,
+        is_admin=is_admin,
+        usage=get_usage(user_id),
+        quota=current_app.config["USER_QUOTA_BYTES"],
+    )
+
+
+class _Batch:
+    """Files received by one upload request, waiting to be committed."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.max_size = current_app.config["UPLOAD_MAX_SIZE"]
+        self.remaining = remaining_quota(user_id)
+        self.results: list[dict] = []
+        self.pending: list[tuple[dict, StoredFile]] = []
+
+    def _limit(self) -> int | None:
+        # Stop reading as soon as the batch cannot fit in the user's quota;
+        # the check is repeated in `commit` once the write lock is held.
+        if self.remaining is None:
+            return self.max_size
+        budget = max(0, self.remaining - sum(r.size_bytes for _, r in self.pending))
+        return budget if self.max_size is None else min(self.max_size, budget)
+
+    def receive(self, name: str, chunks: Iterable[bytes], record: bool = True):
+        # Folder uploads keep their relative path, but never `..`.
+        result = {"name": safe_member_name(name)}
+        self.results.append(result)
+
+        started = time.perf_counter()
+        try:
+            # Archives stay raw on disk so `expand_archives` can read them;
+            # `compress_archives` catches up if they are not unpacked.
+            received = receive_chunks(chunks, self._limit(), compress=not is_archive(name))
+        except UploadTooLarge as e:
+            if e.limit == self.max_size:
+                result["error"] = f"File exceeds the maximum upload size of {format_size(e.limit)}"
+            else:
+                result["error"] = f"File exceeds your remaining storage quota of {format_size(e.limit)}"
+            return
+        if record:
+            record_transfer("upload", received.size_bytes, time.perf_counter() - started)
+
+        self.pending.append((result, received))
+
+    def expand_archives(self):
+        """Replace each received zip or tar archive with its members."""
+        pending, self.pending = self.pending, []
+
+        for result, received in pending:
+            if not is_archive(result["name"]):
+                self.pending.append((result, received))
+                continue
+
+            self.results.remove(result)
+            try:
+                for name, chunks in iter_members(
+                    received.path,
+                    result["name"],
+                    current_app.config["UPLOAD_CHUNK_SIZE"],
+                    current_app.config["UPLOAD_MAX_ARCHIVE_MEMBERS"],
+                    current_app.config["UPLOAD_MAX_ARCHIVE_BYTES"],
+                    current_app.config["UPLOAD_MAX_ARCHIVE_RATIO"],
+                ):
+                    self.receive(name, chunks, record=False)
+            except ArchiveError as e:
+                self.results.append({"name": result["name"], "error": str(e)})
+            finally:
+                discard_received(received)
+
+    def compress_archives(self):
+        """Compress archives that were kept raw in case of extraction."""
+        for i, (result, received) in enumerate(self.pending):
+            if is_archive(result["name"]):
+                self.pending[i] = (result, compress_received(received))
+
+    def commit(self):
+        """Store every pending file and insert their rows in one transaction."""
+        with transaction(immediate=True):
+            for result, received in self.pending:
+                try:
+                    check_quota(self.user_id, received.size_bytes)
+                except QuotaExceeded as e:
+                    discard_received(received)
+                    result["error"] = f"File exceeds your remaining storage quota of {format_size(e.remaining)}"
+                    continue
+
+                stored = commit_blob(received)
+                file = write_db(
+                    "INSERT INTO files (user_id, display_name, file_path, size_bytes, checksum) VALUES (?, ?, ?, ?, ?) RETURNING id",
+                    (self.user_id, result["name"], stored.path, stored.size_bytes, stored.checksum),
+                    single=True,
+                )
+                result.update(id=file["id"], size=stored.size_bytes)
+        self.pending = []
+
+    def discard(self):
+        for _, received in self.pending:
+            discard_received(received)
+        self.pending = []
+
+
+def _upload_response(results: list[dict], message: str | None = None):
+    wants_json = (
+        request.accept_mimetypes.best_match(["text/html", "application/json"])
+        == "application/json"
+    )
+    failed = [result for result in results if "error" in result]
+
+    if wants_json:
+        if message:
+            return jsonify(error=message), 400
+        return jsonify(uploaded=len(results) - len(failed), failed=len(failed), results=results)
+
+    if message:
+        flash(message)
+    elif len(results) == 1:
+        flash(results[0].get("error", "File uploaded successfully"))
+    else:
+        flash(f"Uploaded {len(results) - len(failed)} of {len(results)} files")
+        for result in failed:
+            flash(f"{result['name']}: {result['error']}")
+    return redirect(url_for("files.view"))
 
 
 @bp.route("/upload", methods=["POST"])
 @auth_required()
 def upload(user_id: int):
-    if "file" not in request.files:
-        flash("No file part")
-        return redirect(url_for("files.view"))
+    """Store every `file` part of a multipart request.
 
-    file = request.files["file"]
+    Zip and tar archives are unpacked into their members when the `extract`
+    field is set. The outcome for each file is flashed, or returned as JSON
+    to clients that prefer it.
+    """
+    if request.mimetype != "multipart/form-data":
+        return _upload_response([], "No file part")
 
-    if file.filename == "":
-        flash("No selected file")
-        return redirect(url_for("files.view"))
+    batch = _Batch(user_id)
+    extract = False
+    empty = False
 
-    if file:
-        path = secure_filename(f"{secrets.token_urlsafe(8)}_{file.filename}")
-        full_path = os.path.join(current_app.config["FILE_STORE"], path)
-        file.save(full_path)
-        size_bytes = os.path.getsize(full_path)
+    try:
+        for part in iter_multipart(request, current_app.config["UPLOAD_CHUNK_SIZE"]):
+            if part.name == "extract" and part.filename is None:
+                extract = part.read().lower() in ("1", "on", "true", "yes")
+            elif part.name != "file" or part.filename is None:
+                continue
+            elif part.filename == "":
+                # Browsers send an empty part for a file input left blank.
+                empty = True
+            else:
+                batch.receive(part.filename, part.chunks())
 
-        query_db(
-            "INSERT INTO files (user_id, display_name, file_path, size_bytes) VALUES (?, ?, ?, ?)",
-            (user_id, file.filename, path, size_bytes),
-        )
-        flash("File uploaded successfully")
-        return redirect(url_for("files.view"))
+        # The field can follow the files it applies to, so this is only
+        # known once the whole body has been read.
+        if extract:
+            batch.expand_archives()
+        else:
+            batch.compress_archives()
+        batch.commit()
+    except BaseException:
+        batch.discard()
+        raise
 
-    flash("No file data to upload")
-    return redirect(url_for("files.view"))
+    if not batch.results:
+        return _upload_response([], "No selected file" if empty else "No file part")
+    return _upload_response(batch.results)
 
 
 @bp.route("/download/<int:file_id>", methods=["GET"])
 @auth_required()
 def download(user_id: int, file_id: int):
     file = query_db(
-        "SELECT * FROM files WHERE id = ? AND user_id = ?",
+        "SELECT files.*, blobs.codec FROM files LEFT JOIN blobs ON blobs.path = files.file_path WHERE id = ? AND user_id = ?",
         (file_id, user_id),
         single=True,
     )
@@ -70,26 +247,112 @@ def download(user_id: int, file_id: int):
         flash("File not found")
         return redirect(url_for("files.view"))
 
-    return send_from_directory(
-        current_app.config["FILE_STORE"],
-        file["file_path"],
-        download_name=file["display_name"],
-        as_attachment=True,
+    full_path = safe_join(current_app.config["FILE_STORE"], file["file_path"])
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+
+    checksum = file["checksum"]
+    if checksum is None:
+        # Uploaded before checksums were recorded; backfill on first download.
+        _, checksum = checksum_file(full_path)
+        write_db("UPDATE files SET checksum = ? WHERE id = ?", (checksum, file_id))
+
+    response = send_stored_file(
+        full_path, file["display_name"], checksum, file["codec"], file["size_bytes"]
     )
+    if response.status_code in (200, 206):
+        # The server closes the body once it has gone out, sendfile
+        # included, but by then the app context is gone.
+        started = time.perf_counter()
+        registry = get_metrics()
+        call_on_body_close(
+            response,
+            lambda: record_transfer(
+                "download", response.content_length, time.perf_counter() - started, registry
+            ),
+        )
+    return response
+
+
+def _zip_entries(user_id: int, ids: list[int] | None) -> Iterator[ZipEntry]:
+    """Yield the user's selected files, or all of them if `ids` is None.
+
+    Rows are read in short keyset batches, so no statement stays open while
+    the archive streams.
+    """
+    selection = "" if ids is None else " AND files.id IN (SELECT value FROM json_each(?))"
+    args = () if ids is None else (json.dumps(ids),)
+    last_id = 0
+
+    while rows := query_db(
+        f"SELECT files.id, display_name, file_path, files.size_bytes, uploaded_at, codec FROM files LEFT JOIN blobs ON blobs.path = files.file_path WHERE user_id = ? AND files.id > ?{selection} ORDER BY files.id LIMIT ?",
+        (user_id, last_id, *args, current_app.config["DATABASE_FETCH_SIZE"]),
+    ):
+        last_id = rows[-1]["id"]
+        for row in rows:
+            full_path = safe_join(current_app.config["FILE_STORE"], row["file_path"])
+            if full_path is None or not os.path.isfile(full_path):
+                current_app.logger.warning("Skipping missing file %s in zip download", row["id"])
+                continue
+            yield ZipEntry(
+                safe_member_name(row["display_name"], f"file-{row['id']}"),
+                full_path,
+                row["size_bytes"],
+                datetime.fromisoformat(row["uploaded_at"]),
+                row["codec"],
+            )
+
+
+@bp.route("/download/archive", methods=["GET", "POST"])
+@auth_required()
+def download_archive(user_id: int):
+    """Stream the files given by `id` values, or all files with `all=1`, as a zip."""
+    if request.values.get("all"):
+        ids = None
+    else:
+        ids = request.values.getlist("id", type=int)
+        if not ids:
+            flash("No files selected")
+            return redirect(url_for("files.view"))
+
+    if next(_zip_entries(user_id, ids), None) is None:
+        flash("File not found")
+        return redirect(url_for("files.view"))
+
+    def generate():
+        started = time.perf_counter()
+        sent = 0
+        try:
+            for chunk in stream_zip(
+                _zip_entries(user_id, ids), current_app.config["UPLOAD_CHUNK_SIZE"]
+            ):
+                sent += len(chunk)
+                yield chunk
+        finally:
+            record_transfer("download", sent, time.perf_counter() - started)
+
+    response = current_app.response_class(
+        stream_with_context(generate()), mimetype="application/zip"
+    )
+    response.headers.set("Content-Disposition", "attachment", filename="files.zip")
+    return response
 
 
 @bp.route("/delete/<int:file_id>", methods=["POST"])
 @auth_required()
 def delete(user_id: int, file_id: int):
-    file = query_db(
-        "DELETE FROM files WHERE id = ? AND user_id = ? RETURNING *",
-        (file_id, user_id),
-        single=True,
-    )
+    with transaction(immediate=True):
+        file = write_db(
+            "DELETE FROM files WHERE id = ? AND user_id = ? RETURNING *",
+            (file_id, user_id),
+            single=True,
+        )
+        if file is not None:
+            release_file(file["file_path"])
+
     if file is None:
         flash("File not found")
         return redirect(url_for("files.view"))
 
-    os.remove(os.path.join(current_app.config["FILE_STORE"], file["file_path"]))
     flash("File deleted successfully")
     return redirect(url_for("files.view"))
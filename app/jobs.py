@@ -0,0 +1,177 @@
+"""A durable job queue kept in SQLite.
+
+Requests `enqueue` work inside their own transaction, so a job exists
+exactly when the change that needs it was committed. `flask run-worker`
+claims jobs and calls the handler registered for their kind. A handler
+does one bounded batch per call and returns True while more work
+remains, so progress is committed as it goes, and a job that fails or
+whose worker dies resumes from where it stopped.
+
+A claimed job holds a lease that every batch renews. A job whose lease
+expires is claimed again. Failed jobs are retried with exponential
+backoff, up to JOBS_MAX_ATTEMPTS.
+"""
+
+import json
+import signal
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+
+import click
+from flask import Flask, current_app
+
+from app.db import query_db, transaction, write_db
+
+Handler = Callable[[sqlite3.Row], bool]
+
+HANDLERS: dict[str, Handler] = {}
+
+
+def job(kind: str) -> Callable[[Handler], Handler]:
+    """Register the decorated function as the handler for `kind` jobs."""
+
+    def decorator(handler: Handler) -> Handler:
+        HANDLERS[kind] = handler
+        return handler
+
+    return decorator
+
+
+def enqueue(
+    kind: str, label: str, payload: dict | None = None, run_at: float | None = None
+) -> int:
+    """Queue a job and return its id. `label` is shown on the admin dashboard.
+
+    The job runs as soon as a worker is free, or not before `run_at`.
+    """
+    row = write_db(
+        "INSERT INTO jobs (kind, label, payload, run_at) VALUES (?, ?, ?, ?) RETURNING id",
+        (kind, label, json.dumps(payload or {}), time.time() if run_at is None else run_at),
+        single=True,
+    )
+    return row["id"]
+
+
+def recent_jobs(limit: int = 10) -> list[sqlite3.Row]:
+    return query_db("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+
+
+def claim_job() -> sqlite3.Row | None:
+    """Lease the next runnable job, if any."""
+    now = time.time()
+    return write_db(
+        """
+        UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status = 'queued' AND run_at <= ?) OR (status = 'running' AND lease_until < ?)
+            ORDER BY id LIMIT 1
+        )
+        RETURNING *
+        """,
+        (now + current_app.config["JOBS_LEASE"], now, now),
+        single=True,
+    )
+
+
+def advance(job: sqlite3.Row, done: int):
+    """Record `done` more units of progress and renew the job's lease.
+
+    Handlers call this inside the transaction that did the work.
+    """
+    write_db(
+        "UPDATE jobs SET done = done + ?, lease_until = ? WHERE id = ?",
+        (done, time.time() + current_app.config["JOBS_LEASE"], job["id"]),
+    )
+
+
+def run_job(job: sqlite3.Row, stop: threading.Event):
+    """Run `job` batch by batch until it finishes, fails, or `stop` is set."""
+    handler = HANDLERS.get(job["kind"])
+
+    try:
+        if handler is None:
+            raise LookupError(f"No handler for job kind {job['kind']!r}")
+        while handler(job):
+            if stop.is_set():
+                # Hand the job back; the next worker resumes it at once.
+                write_db(
+                    "UPDATE jobs SET status = 'queued', attempts = attempts - 1, run_at = ? WHERE id = ?",
+                    (time.time(), job["id"]),
+                )
+                return
+    except Exception as e:
+        current_app.logger.exception("Job %s failed", job["id"])
+        if job["attempts"] >= current_app.config["JOBS_MAX_ATTEMPTS"]:
+            write_db(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (str(e), time.time(), job["id"]),
+            )
+        else:
+            delay = current_app.config["JOBS_RETRY_DELAY"] * 2 ** (job["attempts"] - 1)
+            write_db(
+                "UPDATE jobs SET status = 'queued', error = ?, run_at = ? WHERE id = ?",
+                (str(e), time.time() + delay, job["id"]),
+            )
+        return
+
+    write_db(
+        "UPDATE jobs SET status = 'done', error = NULL, finished_at = ? WHERE id = ?",
+        (time.time(), job["id"]),
+    )
+
+
+def prune_jobs():
+    """Forget finished jobs older than JOBS_RETENTION seconds."""
+    write_db(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+        (time.time() - current_app.config["JOBS_RETENTION"],),
+    )
+
+
+def work(once: bool = False, stop: threading.Event | None = None) -> int:
+    """Process jobs until `stop` is set, or until none are left if `once`.
+
+    Returns the number of jobs claimed.
+    """
+    stop = stop or threading.Event()
+    claimed = 0
+    prune_jobs()
+
+    while not stop.is_set():
+        job = claim_job()
+        if job is None:
+            if once:
+                break
+            prune_jobs()
+            stop.wait(current_app.config["JOBS_POLL_INTERVAL"])
+            continue
+
+        claimed += 1
+        run_job(job, stop)
+
+    return claimed
+
+
+@click.command("run-worker")
+@click.option("--once", is_flag=True, help="Exit when no job is runnable instead of polling.")
+def run_worker_command(once: bool):
+    """Process background jobs until interrupted."""
+    stop = threading.Event()
+    # Finish the current batch on Ctrl-C or SIGTERM rather than dying mid-way.
+    previous = {
+        signum: signal.signal(signum, lambda *_: stop.set())
+        for signum in (signal.SIGINT, signal.SIGTERM)
+    }
+    try:
+        claimed = work(once, stop)
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+    click.echo(f"Processed {claimed} job(s).")
+
+
+def init_app(app: Flask):
+    app.cli.add_command(run_worker_command)
@@ -0,0 +1,121 @@
+"""Incremental multipart/form-data parsing straight off the request stream.
+
+Werkzeug's form parser spools every file part to a temporary file before
+the view runs. `iter_multipart` instead yields each part as it arrives so
+file data can be written to its final location chunk by chunk.
+"""
+
+from collections.abc import Iterator
+
+from flask import Request
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import (
+    Data,
+    Epilogue,
+    Event,
+    Field,
+    File,
+    MultipartDecoder,
+    NeedData,
+)
+
+
+class Part:
+    """One part of a multipart body.
+
+    The part's data must be consumed before advancing to the next part;
+    anything left unread is skipped.
+    """
+
+    def __init__(
+        self,
+        parser: "MultipartStream",
+        name: str,
+        filename: str | None,
+        headers: Headers,
+    ):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.done = False
+        self._parser = parser
+
+    @property
+    def content_type(self) -> str | None:
+        return self.headers.get("Content-Type")
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the part's data as it is read from the stream."""
+        while not self.done:
+            event = self._parser.next_event()
+            if not isinstance(event, Data):
+                raise BadRequest("Malformed multipart body.")
+            if not event.more_data:
+                self.done = True
+            if event.data:
+                yield event.data
+
+    def read(self) -> str:
+        """Read a form field's value, bounded by the parser's field limit."""
+        value = bytearray()
+        for chunk in self.chunks():
+            value.extend(chunk)
+            if len(value) > self._parser.max_field_size:
+                raise RequestEntityTooLarge()
+        return value.decode()
+
+
+class MultipartStream:
+    def __init__(
+        self,
+        stream,
+        boundary: bytes,
+        chunk_size: int,
+        max_field_size: int = 500_000,
+        max_parts: int = 1000,
+    ):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_field_size = max_field_size
+        self._decoder = MultipartDecoder(boundary, max_parts=max_parts)
+
+    def next_event(self) -> Event:
+        try:
+            while True:
+                event = self._decoder.next_event()
+                if not isinstance(event, NeedData):
+                    return event
+                chunk = self.stream.read(self.chunk_size)
+                self._decoder.receive_data(chunk or None)
+        except ValueError as e:
+            raise BadRequest(f"Malformed multipart body: {e}") from e
+
+    def __iter__(self) -> Iterator[Part]:
+        while True:
+            event = self.next_event()
+
+            if isinstance(event, (Field, File)):
+                part = Part(
+                    self,
+                    event.name,
+                    event.filename if isinstance(event, File) else None,
+                    event.headers,
+                )
+                yield part
+                for _ in part.chunks():
+                    pass
+            elif isinstance(event, Epilogue):
+                return
+
+
+def iter_multipart(request: Request, chunk_size: int) -> Iterator[Part]:
+    """Yield the parts of a multipart/form-data request in arrival order."""
+    _, options = parse_options_header(request.headers.get("Content-Type", ""))
+    boundary = options.get("boundary")
+
+    if request.mimetype != "multipart/form-data" or not boundary:
+        raise BadRequest("Expected a multipart/form-data body.")
+
+    return iter(MultipartStream(request.stream, boundary.encode(), chunk_size))
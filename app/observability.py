@@ -1,21 +1,214 @@
+import atexit
+import fcntl
+import glob
+import hmac
 import os
-import jwt
+import queue
+import threading
+import time
 import json
 import logging
 from datetime import datetime
-from flask import request, current_app
+from flask import Response, abort, g, request, current_app
+
+
+class AccessLogWriter:
+    """
+    Appends log lines to a file from a background thread.
+
+    Lines are queued by the request path and written in batches once
+    `batch_size` lines are waiting or `flush_interval` seconds have passed.
+    Each batch is a single write on an O_APPEND file, so batches from
+    different workers never interleave mid-line. When the queue is full new
+    lines are dropped and counted rather than blocking requests.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_queue=10000,
+        batch_size=256,
+        flush_interval=1.0,
+        max_bytes=0,
+        rotate_interval=0,
+        backup_count=5,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.pid = os.getpid()
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._file = None
+        self._stats = {"written": 0, "dropped": 0, "batches": 0, "rotations": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="access-log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+
+    def close(self):
+        """Drain everything queued so far, then stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, "queue_depth": self._queue.qsize()}
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while True:
+            try:
+                line = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                line = ""
+
+            if line is None:
+                self._flush(batch)
+                if self._file is not None:
+                    self._file.close()
+                return
+
+            if line:
+                batch.append(line)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def _flush(self, batch):
+        if not batch:
+            return
+
+        data = "".join(batch)
+        try:
+            self._rotate_if_due(len(data))
+            self._reopen_if_moved()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            logging.getLogger(__name__).error(f"Failed to write to access log: {e}")
+            return
+
+        with self._lock:
+            self._stats["written"] += len(batch)
+            self._stats["batches"] += 1
+
+    def _reopen_if_moved(self):
+        """Reopen the log when another worker (or logrotate) renamed it."""
+        if self._file is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self._file.close()
+
+        self._file = open(self.path, "a")
+
+    def _rotate_if_due(self, incoming):
+        if not (self.max_bytes or self.rotate_interval) or not os.path.exists(self.path):
+            return
+
+        # Every worker may decide to rotate at the same moment; the lock and
+        # the re-check under it make sure only one of them does.
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return
+
+            if self.rotate_interval:
+                period_start = time.time() // self.rotate_interval * self.rotate_interval
+                if stat.st_mtime < period_start:
+                    suffix = time.strftime("%Y%m%d-%H%M%S", time.gmtime(stat.st_mtime))
+                    os.rename(self.path, f"{self.path}.{suffix}")
+                    self._prune(f"{self.path}.*-*")
+                    self._count_rotation()
+                    return
+
+            if self.max_bytes and stat.st_size + incoming > self.max_bytes:
+                for i in range(self.backup_count - 1, 0, -1):
+                    if os.path.exists(f"{self.path}.{i}"):
+                        os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                if self.backup_count:
+                    os.replace(self.path, f"{self.path}.1")
+                else:
+                    os.remove(self.path)
+                self._count_rotation()
+
+    def _prune(self, pattern):
+        for old in sorted(glob.glob(pattern))[: -self.backup_count or None]:
+            os.remove(old)
+
+    def _count_rotation(self):
+        with self._lock:
+            self._stats["rotations"] += 1
+
+
+# Guards the lazy creation of the per-worker writer and registry, which
+# request threads of a gthread worker can otherwise race to build twice.
+_extensions_lock = threading.Lock()
+
+
+def get_access_log():
+    """Returns this worker's access log writer, starting it on first use."""
+    writer = current_app.extensions.get("access_log")
+
+    if writer is None or writer.pid != os.getpid():
+        with _extensions_lock:
+            writer = current_app.extensions.get("access_log")
+            if writer is None or writer.pid != os.getpid():
+                config = current_app.config
+                writer = AccessLogWriter(
+                    config["ACCESS_LOG"] or os.path.join(current_app.instance_path, "access.log"),
+                    max_queue=config["ACCESS_LOG_MAX_QUEUE"],
+                    batch_size=config["ACCESS_LOG_BATCH_SIZE"],
+                    flush_interval=config["ACCESS_LOG_FLUSH_INTERVAL"],
+                    max_bytes=config["ACCESS_LOG_MAX_BYTES"],
+                    rotate_interval=config["ACCESS_LOG_ROTATE_INTERVAL"],
+                    backup_count=config["ACCESS_LOG_BACKUP_COUNT"],
+                )
+                current_app.extensions["access_log"] = writer
+                atexit.register(writer.close)
+
+    return writer
+
+
+class _AccessLogHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            get_access_log().write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
 
 def get_audit_logger():
-    """Configures the logger to write to the instance folder."""
+    """Returns the logger whose records go to the access log writer."""
     logger = logging.getLogger('audit_log')
     if not logger.handlers:
-   
-        log_path = os.path.join(current_app.instance_path, 'access.log')
-        handler = logging.FileHandler(log_path)
-        logger.addHandler(handler)
+        logger.addHandler(_AccessLogHandler())
         logger.setLevel(logging.INFO)
+        logger.propagate = False
     return logger
 
+
 def initialize_logging(app):
     """
     Sets up the application-wide logging system.
@@ -27,23 +220,12 @@ def initialize_logging(app):
         """
         Captures metadata for every request in Common Log Format.
         """
-      
-        username = "-"
-        token = request.cookies.get("access_token")
-        
-        if token:
-            try:
-                data = jwt.decode(
-                    token, 
-                    current_app.config["SECRET_KEY"], 
-                    algorithms=["HS256"]
-                )
-                raw_username = data.get("username", "unknown")
 
-                username = json.dumps(raw_username) 
-            except Exception:
-                username = "-"
+        from app.auth import resolve_identity
 
+        # Renewing tokens is the views' business, not the logger's.
+        identity = resolve_identity(refresh=False)
+        username = json.dumps(identity.username) if identity else "-"
 
         ip = request.remote_addr or "127.0.0.1"
         timestamp = datetime.now().strftime('%d/%b/%Y:%H:%M:%S +0000')
@@ -52,16 +234,287 @@ def initialize_logging(app):
         size = response.calculate_content_length() or 0
         user_agent = request.headers.get('User-Agent', 'unknown')
 
-        log_line = f'{ip} - {username} [{timestamp}] "{request_line}" {status} {size} "{user_agent}"\n'
-        
- 
-        log_path = os.path.join(current_app.instance_path, "access.log")
-        try:
-            with open(log_path, "a") as f:
-                f.write(log_line)
-        except Exception as e:
+        log_line = f'{ip} - {username} [{timestamp}] "{request_line}" {status} {size} "{user_agent}"'
+
+        get_audit_logger().info(log_line)
 
-            app.logger.error(f"Failed to write to access log: {e}")
-            
         return response
-    
\ No newline at end of file
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(0, 22, 2))
+
+METRICS = {
+    "http_requests_total": ("counter", "Requests served, by endpoint, method and status."),
+    "http_request_duration_seconds": ("histogram", "Time spent handling a request.", LATENCY_BUCKETS),
+    "http_request_bytes_total": ("counter", "Request body bytes received."),
+    "http_response_bytes_total": ("counter", "Response body bytes sent, where the length is known."),
+    "db_queries_total": ("counter", "Statements run through query_db and write_db."),
+    "db_query_duration_seconds": ("histogram", "Time spent in query_db and write_db.", LATENCY_BUCKETS),
+    "transfer_bytes_total": ("counter", "File content bytes uploaded or downloaded."),
+    "transfer_seconds_total": ("counter", "Wall time spent on file uploads or downloads."),
+    "transfer_throughput_bytes_per_second": ("histogram", "Per-transfer file throughput.", THROUGHPUT_BUCKETS),
+    "db_pool_events_total": ("counter", "Connection pool checkouts, waits, misses, timeouts and invalidations."),
+    "access_log_lines_total": ("counter", "Access log lines written or dropped."),
+    "access_log_queue_depth": ("gauge", "Access log lines waiting to be written."),
+    "rate_limited_total": ("counter", "Requests rejected by a rate limit bucket."),
+}
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms for one worker process.
+
+    Workers periodically snapshot their registry to METRICS_DIR; the
+    /metrics endpoint sums the snapshots of every worker started by the
+    same parent (the gunicorn master), so scrapes see node-wide totals
+    whichever worker answers them.
+    """
+
+    def __init__(self, directory, sync_interval=5.0):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.pid = os.getpid()
+        self.ppid = os.getppid()
+        self._lock = threading.Lock()
+        self._values = {}
+        self._last_sync = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                [name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in self._values.items()
+            ]
+
+    def _snapshot_path(self, pid=None):
+        return os.path.join(self.directory, f"{self.ppid}-{pid or self.pid}.json")
+
+    def sync(self, force=False):
+        """Write this worker's snapshot, at most once per sync interval."""
+        now = time.monotonic()
+        if not force and now - self._last_sync < self.sync_interval:
+            return
+        self._last_sync = now
+
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self._snapshot_path() + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, self._snapshot_path())
+
+    def collect(self):
+        """Sum the snapshots of all sibling workers, dropping stale runs.
+
+        Counters of sibling workers that have exited still count, so
+        totals do not drop when gunicorn replaces a worker; their gauges
+        no longer describe anything and are skipped. Snapshots of other
+        servers sharing the directory are left alone while their worker
+        is alive.
+        """
+        self.sync(force=True)
+        totals = {}
+
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                ppid, pid = map(int, os.path.basename(path)[:-len(".json")].split("-"))
+            except ValueError:
+                continue
+            alive = _pid_alive(pid)
+
+            if ppid != self.ppid:
+                if not alive:
+                    # Left behind by a previous server run.
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                continue
+
+            try:
+                with open(path) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for name, labels, value in entries:
+                if not alive and METRICS.get(name, ("",))[0] == "gauge":
+                    continue
+                key = (name, tuple(tuple(label) for label in labels))
+                if isinstance(value, list):
+                    current = totals.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        current[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+
+        return totals
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, but belongs to someone else.
+    return True
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+
+def render_metrics(totals):
+    """Renders collected metrics in the Prometheus text exposition format."""
+    lines = []
+
+    for name, (kind, help_text, *rest) in METRICS.items():
+        series = sorted((labels, value) for (n, labels), value in totals.items() if n == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+
+            for bound, count in zip(rest[0] + ("+Inf",), value[:-2] + value[-1:]):
+                le = bound if bound == "+Inf" else repr(float(bound))
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', le)])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_metrics():
+    """Returns this worker's metrics registry."""
+    registry = current_app.extensions.get("metrics")
+
+    if registry is None or registry.pid != os.getpid():
+        with _extensions_lock:
+            registry = current_app.extensions.get("metrics")
+            if registry is None or registry.pid != os.getpid():
+                registry = MetricsRegistry(
+                    current_app.config["METRICS_DIR"]
+                    or os.path.join(current_app.instance_path, "metrics"),
+                    sync_interval=current_app.config["METRICS_SYNC_INTERVAL"],
+                )
+                current_app.extensions["metrics"] = registry
+                atexit.register(registry.sync, force=True)
+
+    return registry
+
+
+def record_query(kind, seconds):
+    """Counts a statement run by the DB layer; `kind` is "read" or "write"."""
+    registry = get_metrics()
+    registry.inc("db_queries_total", kind=kind)
+    registry.observe("db_query_duration_seconds", seconds, kind=kind)
+
+
+def record_transfer(direction, size, seconds, registry=None):
+    """Records the bytes and duration of one file upload or download.
+
+    Pass `registry` when recording after the app context has gone.
+    """
+    registry = registry or get_metrics()
+    registry.inc("transfer_bytes_total", size, direction=direction)
+    registry.inc("transfer_seconds_total", seconds, direction=direction)
+    if seconds > 0:
+        registry.observe("transfer_throughput_bytes_per_second", size / seconds, direction=direction)
+
+
+def _sample_components(registry):
+    """Copies pool and access log counters into the registry before a sync."""
+    samples = {}
+
+    pool = current_app.extensions.get("db_pool")
+    if pool is not None and pool.pid == os.getpid():
+        stats = pool.stats()
+        for event in ("checkouts", "waits", "misses", "timeouts", "invalidated"):
+            samples[("db_pool_events_total", (("event", event),))] = stats[event]
+
+    writer = current_app.extensions.get("access_log")
+    if writer is not None and writer.pid == os.getpid():
+        stats = writer.stats()
+        samples[("access_log_lines_total", (("outcome", "written"),))] = stats["written"]
+        samples[("access_log_lines_total", (("outcome", "dropped"),))] = stats["dropped"]
+        samples[("access_log_queue_depth", ())] = stats["queue_depth"]
+
+    with registry._lock:
+        registry._values.update(samples)
+
+
+def initialize_metrics(app):
+    """
+    Instruments every request and serves the /metrics endpoint.
+    Called once during app creation.
+    """
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_metrics(response):
+        started = g.pop("request_started", None)
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        registry = get_metrics()
+
+        registry.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+        if started is not None:
+            registry.observe(
+                "http_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint
+            )
+        registry.inc("http_request_bytes_total", request.content_length or 0, endpoint=endpoint)
+        if response.content_length is not None:
+            registry.inc("http_response_bytes_total", response.content_length, endpoint=endpoint)
+
+        _sample_components(registry)
+        registry.sync()
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        # Off unless asked for: the app is usually bound to a public address.
+        if not current_app.config["METRICS_ENABLED"]:
+            abort(404)
+        token = current_app.config["METRICS_TOKEN"]
+        if token and not hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            return Response("Unauthorized\n", 401, {"WWW-Authenticate": "Bearer"})
+
+        registry = get_metrics()
+        _sample_components(registry)
+        return Response(
+            render_metrics(registry.collect()),
+            mimetype="text/plain; version=0.0.4",
+        )
@@ -0,0 +1,107 @@
+"""Keyset (cursor) pagination for the dashboard listings."""
+
+import base64
+import binascii
+import json
+import sqlite3
+from collections.abc import Iterator
+from itertools import chain, islice
+
+from flask import abort, current_app, request
+
+from app.db import iter_db
+
+
+def encode_cursor(value, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, binascii.Error):
+        abort(400, "Invalid cursor.")
+    # Anything else would fail while binding, possibly mid-stream.
+    if (
+        not isinstance(value, (str, int, float, type(None)))
+        or not isinstance(row_id, int)
+        or isinstance(row_id, bool)
+        or not -(2**63) <= row_id < 2**63
+        or (isinstance(value, int) and not -(2**63) <= value < 2**63)
+    ):
+        abort(400, "Invalid cursor.")
+    return value, row_id
+
+
+class Page:
+    """One page of rows, read lazily from the database cursor.
+
+    Iterate it once. `next_cursor` is only known after the loop has
+    finished, which suits templates that render the pager below the rows.
+    """
+
+    def __init__(
+        self, rows: Iterator[sqlite3.Row], column: str, sort: str, order: str, limit: int
+    ):
+        self.sort = sort
+        self.order = order
+        self.limit = limit
+        self.next_cursor: str | None = None
+        self._rows = rows
+        self._column = column
+        self._peeked: list[sqlite3.Row] = []
+
+    def __bool__(self) -> bool:
+        if not self._peeked:
+            self._peeked = list(islice(self._rows, 1))
+        return bool(self._peeked)
+
+    def __iter__(self) -> Iterator[sqlite3.Row]:
+        last = None
+        for count, row in enumerate(chain(self._peeked, self._rows)):
+            if count == self.limit:
+                # The extra row fetched beyond the limit proves there is more.
+                self.next_cursor = encode_cursor(last[self._column], last["id"])
+                break
+            yield row
+            last = row
+        self._peeked = []
+        self._rows.close()
+
+
+def keyset_page(
+    select: str,
+    where: str,
+    args: tuple,
+    sort_columns: dict[str, str],
+    default_sort: str,
+) -> Page:
+    """Page through `select`, ordered by a sort column with `id` as tiebreak.
+
+    The sort key, order, page size and cursor come from the query string
+    (`sort`, `order`, `limit`, `cursor`). Each page continues strictly after
+    the (sort value, id) pair of the previous page's last row, so every page
+    is an index range scan no matter how deep it is.
+    """
+    sort = request.args.get("sort", default_sort)
+    if sort not in sort_columns:
+        sort = default_sort
+    column = sort_columns[sort]
+    order = "asc" if request.args.get("order") == "asc" else "desc"
+
+    limit = request.args.get("limit", current_app.config["DASHBOARD_PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, current_app.config["DASHBOARD_MAX_PAGE_SIZE"]))
+
+    conditions = [where] if where else []
+    params = list(args)
+    cursor = request.args.get("cursor")
+    if cursor:
+        conditions.append(f"({column}, id) {'>' if order == 'asc' else '<'} (?, ?)")
+        params.extend(decode_cursor(cursor))
+
+    query = select
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {column} {order}, id {order} LIMIT ?"
+
+    return Page(iter_db(query, (*params, limit + 1)), column, sort, order, limit)
@@ -0,0 +1,156 @@
+"""Password hashing and verification off the request thread.
+
+The KDF is deliberately slow and CPU-bound, so a burst of logins can take
+every core away from ordinary requests. Each worker hands KDF calls to its
+own small process pool instead:
+
+- PASSWORD_HASH_WORKERS sets the number of pool processes per app worker.
+  0 hashes inline. By default the node's CPUs are split between the
+  WEB_WORKERS app workers, with at least one process each.
+- PASSWORD_HASH_NICE lowers the pool processes' scheduling priority.
+- PASSWORD_HASH_CONCURRENCY caps how many calls run or wait at once.
+- A call that cannot start within PASSWORD_HASH_TIMEOUT seconds raises
+  `HashPoolBusy`, which the views report as 503.
+
+Bulk hashing maps its batch across the whole pool and is not capped.
+"""
+
+import multiprocessing
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashPoolBusy(Exception):
+    """Raised when no hashing slot frees up within the queue timeout."""
+
+
+def _lower_priority(increment: int):
+    if increment:
+        os.nice(increment)
+
+
+class HashPool:
+    """A lazily started, bounded process pool for password hashing."""
+
+    def __init__(self, workers: int, concurrency: int, timeout: float, nice: int = 0):
+        self.workers = workers
+        self.timeout = timeout
+        self.nice = nice
+        self.pid = os.getpid()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs background threads is unsafe,
+                # so start the workers from a clean interpreter.
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context(
+                    "forkserver" if "forkserver" in methods else "spawn"
+                )
+                self._executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=context,
+                    initializer=_lower_priority,
+                    initargs=(self.nice,),
+                )
+            return self._executor
+
+    def _acquire_slot(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashPoolBusy(f"No password hashing slot free within {self.timeout}s")
+
+    def _call(self, fn: Callable, *args):
+        self._acquire_slot()
+        try:
+            if self.workers < 1:
+                return fn(*args)
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._call(generate_password_hash, password)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._call(check_password_hash, password_hash, password)
+
+    def hash_many(self, passwords: list[str]) -> list[str]:
+        """Hash `passwords`, returning the hashes in the same order.
+
+        Every password takes a slot like `hash` does, so a bulk import
+        shares the concurrency limit with logins rather than queueing
+        ahead of them.
+        """
+        if self.workers < 1:
+            return [self.hash(password) for password in passwords]
+
+        futures = []
+        try:
+            for password in passwords:
+                self._acquire_slot()
+                try:
+                    future = self._get_executor().submit(generate_password_hash, password)
+                except BaseException:
+                    self._slots.release()
+                    raise
+                future.add_done_callback(lambda _: self._slots.release())
+                futures.append(future)
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+
+# Guards the lazy creation of the per-worker pool, which request threads of
+# a gthread worker can otherwise race to build twice.
+_extensions_lock = threading.Lock()
+
+
+def get_hash_pool() -> HashPool:
+    """Return this worker's hash pool, rebuilding it if we were forked."""
+    pool: HashPool | None = current_app.extensions.get("password_pool")
+
+    if pool is None or pool.pid != os.getpid():
+        with _extensions_lock:
+            pool = current_app.extensions.get("password_pool")
+            if pool is None or pool.pid != os.getpid():
+                config = current_app.config
+                workers = config["PASSWORD_HASH_WORKERS"]
+                if workers is None:
+                    workers = max(1, (os.cpu_count() or 1) // max(1, config["WEB_WORKERS"]))
+                pool = HashPool(
+                    workers,
+                    config["PASSWORD_HASH_CONCURRENCY"] or max(workers, 1),
+                    config["PASSWORD_HASH_TIMEOUT"],
+                    config["PASSWORD_HASH_NICE"],
+                )
+                current_app.extensions["password_pool"] = pool
+
+    return pool
+
+
+def hash_password(password: str) -> str:
+    return get_hash_pool().hash(password)
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    return get_hash_pool().verify(password_hash, password)
+
+
+def hash_passwords(passwords: list[str]) -> list[str]:
+    return get_hash_pool().hash_many(passwords)
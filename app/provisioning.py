@@ -0,0 +1,118 @@
+"""Create many user accounts at once from CSV or JSON.
+
+Input is a list of records with `username`, `password` and an optional
+`is_admin` flag. JSON may be a bare list or an object with a `users` list;
+CSV needs a header row naming the columns. Passwords are hashed in the
+process pool before any write, then every account is inserted in one
+transaction. A bad row is reported without failing the rest.
+"""
+
+import csv
+import io
+import json
+
+import click
+from flask import Flask
+
+from app.db import transaction, write_db
+from app.passwords import hash_passwords
+
+_TRUE = {"1", "true", "yes", "on"}
+
+
+class ProvisioningError(ValueError):
+    """Raised when the input as a whole cannot be parsed."""
+
+
+def parse_users(text: str, fmt: str) -> list:
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or not {"username", "password"} <= set(reader.fieldnames):
+            raise ProvisioningError("CSV input needs a header with username and password columns.")
+        return list(reader)
+
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise ProvisioningError(f"Invalid JSON: {e}") from e
+    if isinstance(data, dict):
+        data = data.get("users")
+    if not isinstance(data, list):
+        raise ProvisioningError("JSON input must be a list of users or an object with a users list.")
+    return data
+
+
+def _validate(record) -> tuple[str, str, int]:
+    if not isinstance(record, dict):
+        raise ValueError("Expected an object with username and password.")
+
+    username = record.get("username")
+    password = record.get("password")
+    if not isinstance(username, str) or not username.strip():
+        raise ValueError("Username is required.")
+    if not isinstance(password, str) or not password:
+        raise ValueError("Password is required.")
+
+    is_admin = record.get("is_admin")
+    admin = is_admin is True or str(is_admin).strip().lower() in _TRUE
+    return username.strip(), password, 1 if admin else 0
+
+
+def provision_users(records: list) -> list[dict]:
+    """Create the users in `records` and return one result per record.
+
+    Each result has the 1-based `row`, the `username` and either the new
+    user's `id` or an `error`.
+    """
+    results: list[dict] = [{} for _ in records]
+    valid = []
+
+    for i, record in enumerate(records):
+        try:
+            valid.append((i, *_validate(record)))
+        except ValueError as e:
+            username = record.get("username") if isinstance(record, dict) else None
+            results[i] = {"row": i + 1, "username": username, "error": str(e)}
+
+    hashes = hash_passwords([password for _, _, password, _ in valid])
+
+    with transaction(immediate=True):
+        for (i, username, _, is_admin), password_hash in zip(valid, hashes):
+            user = write_db(
+                "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?) ON CONFLICT (username) DO NOTHING RETURNING id",
+                (username, password_hash, is_admin),
+                single=True,
+            )
+            if user is None:
+                results[i] = {"row": i + 1, "username": username, "error": "Username already exists."}
+            else:
+                results[i] = {"row": i + 1, "username": username, "id": user["id"]}
+
+    return results
+
+
+@click.command("create-users")
+@click.argument("source", type=click.File("r"))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "json"]),
+    help="Input format; guessed from the file extension by default.",
+)
+def create_users_command(source, fmt: str | None):
+    """Create user accounts from a CSV or JSON file ('-' for stdin)."""
+    fmt = fmt or ("json" if source.name.endswith(".json") else "csv")
+    try:
+        records = parse_users(source.read(), fmt)
+    except ProvisioningError as e:
+        raise click.ClickException(str(e))
+
+    results = provision_users(records)
+    failed = [result for result in results if "error" in result]
+    for result in failed:
+        click.echo(f"Row {result['row']} ({result['username']}): {result['error']}", err=True)
+    click.echo(f"Created {len(results) - len(failed)} user(s), {len(failed)} failed.")
+
+
+def init_app(app: Flask):
+    app.cli.add_command(create_users_command)
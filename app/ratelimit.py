@@ -0,0 +1,138 @@
+"""Token-bucket rate limiting shared by every worker on the node.
+
+Buckets live in the `rate_limits` table, so all gunicorn workers that
+share the database draw from the same budget. A bucket is configured as
+(capacity, period): up to `capacity` requests in a burst, refilled
+continuously at `capacity` per `period` seconds. Each check is a single
+UPSERT.
+
+A rejected request still spends a token, down to a floor of -1. A client
+that keeps hammering therefore stays locked out. One that backs off
+gets in again after two tokens' worth of refill.
+
+Checks run in `before_request`, ahead of password hashing and, except
+for the per-username login budget, body parsing:
+- RATE_LIMIT_LOGIN_IP and RATE_LIMIT_LOGIN_USERNAME apply to login
+  attempts.
+- RATE_LIMIT_UPLOAD applies to uploads, including resumable upload
+  sessions and their chunks, per user (or per IP when signed out).
+Set a budget to None to disable it.
+"""
+
+import math
+import random
+import time
+
+from flask import Flask, current_app, flash, make_response, render_template, request
+from werkzeug.exceptions import TooManyRequests
+
+from app.db import transaction, write_db
+from app.observability import get_metrics
+
+# Share of checks that also sweep long-idle buckets.
+_PRUNE_PROBABILITY = 0.01
+
+
+def consume(key: str, capacity: int, period: float) -> float:
+    """Take one token from bucket `key`.
+
+    Returns 0 if the request may proceed, otherwise the seconds until the
+    bucket has a token again.
+    """
+    rate = capacity / period
+    now = time.time()
+    bucket = write_db(
+        """
+        INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :capacity - 1, :now)
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = max(-1, min(:capacity, tokens + (:now - updated_at) * :rate) - 1),
+            updated_at = :now
+        RETURNING tokens
+        """,
+        {"key": key, "capacity": capacity, "now": now, "rate": rate},
+        single=True,
+    )
+    if bucket["tokens"] >= 0:
+        return 0
+    return (1 - bucket["tokens"]) / rate
+
+
+def check_limits(buckets: list[tuple[str, str, tuple[int, float] | None]]) -> float:
+    """Charge every (name, key, budget) bucket; return the longest wait.
+
+    All buckets are charged in one transaction, even when an earlier one
+    is already exhausted, so attempts against many keys are counted for
+    each of them.
+    """
+    wait = 0.0
+
+    with transaction(immediate=True):
+        if random.random() < _PRUNE_PROBABILITY:
+            write_db(
+                "DELETE FROM rate_limits WHERE updated_at < ?",
+                (time.time() - current_app.config["RATE_LIMIT_RETENTION"],),
+            )
+        for name, key, budget in buckets:
+            if budget is None:
+                continue
+            retry_after = consume(f"{name}:{key}", *budget)
+            if retry_after:
+                get_metrics().inc("rate_limited_total", bucket=name)
+                wait = max(wait, retry_after)
+
+    return wait
+
+
+# Every way of sending file content draws from the upload budget.
+_UPLOAD_ENDPOINTS = frozenset(("files.upload", "uploads.create", "uploads.put_chunk"))
+
+
+def _refuse_login(wait: float):
+    flash("Too many login attempts. Please wait before trying again.")
+    response = make_response(render_template("login.html"), 429)
+    response.headers["Retry-After"] = str(math.ceil(wait))
+    return response
+
+
+def enforce_rate_limits():
+    if request.method not in ("POST", "PUT"):
+        return None
+    config = current_app.config
+
+    if request.endpoint == "auth.login":
+        # The per-IP budget needs nothing from the body, so a flood is
+        # turned away before its form is parsed.
+        wait = check_limits([("login_ip", request.remote_addr or "-", config["RATE_LIMIT_LOGIN_IP"])])
+        if wait:
+            return _refuse_login(wait)
+
+        # The username comes from a small urlencoded form.
+        wait = check_limits(
+            [
+                (
+                    "login_username",
+                    (request.form.get("username") or "").lower(),
+                    config["RATE_LIMIT_LOGIN_USERNAME"],
+                )
+            ]
+        )
+        if wait:
+            return _refuse_login(wait)
+
+    elif request.endpoint in _UPLOAD_ENDPOINTS:
+        from app.auth import resolve_identity
+
+        identity = resolve_identity()
+        key = f"user:{identity.user_id}" if identity else f"ip:{request.remote_addr}"
+        wait = check_limits([("upload", key, config["RATE_LIMIT_UPLOAD"])])
+        if wait:
+            raise TooManyRequests(
+                "Too many uploads. Please wait before trying again.",
+                retry_after=math.ceil(wait),
+            )
+
+    return None
+
+
+def init_app(app: Flask):
+    app.before_request(enforce_rate_limits)
@@ -0,0 +1,280 @@
+import math
+import secrets
+import sqlite3
+import time
+
+from flask import Blueprint, current_app, jsonify, request
+
+from app.auth import auth_required
+from app.db import on_commit, query_db, transaction, write_db
+from app.jobs import advance, enqueue, job
+from app.observability import record_transfer
+from app.storage import (
+    QuotaExceeded,
+    check_quota,
+    commit_blob,
+    create_partial,
+    discard_partial,
+    discard_received,
+    finish_partial,
+    remaining_quota,
+    stale_partials,
+    write_partial,
+)
+
+bp = Blueprint("uploads", __name__, url_prefix="/dashboard/uploads")
+
+
+def _error(message: str, status: int):
+    return jsonify(error=message), status
+
+
+def _get_session(user_id: int, upload_id: str):
+    return query_db(
+        "SELECT * FROM upload_sessions WHERE id = ? AND user_id = ?",
+        (upload_id, user_id),
+        single=True,
+    )
+
+
+def _chunk_count(session) -> int:
+    return math.ceil(session["size_bytes"] / session["chunk_size"])
+
+
+def _schedule_expiry(run_at: float):
+    """Queue `expire_uploads` for `run_at` unless a run is already pending."""
+    pending = query_db(
+        "SELECT 1 FROM jobs WHERE kind = 'expire_uploads' AND status IN ('queued', 'running') LIMIT 1",
+        single=True,
+    )
+    if pending is None:
+        enqueue("expire_uploads", "Expire abandoned uploads", run_at=run_at)
+
+
+@job("expire_uploads")
+def expire_uploads(job: sqlite3.Row) -> bool:
+    """Drop a batch of upload sessions older than UPLOAD_SESSION_TTL.
+
+    Once none are left, also removes partial files that no session owns,
+    such as those of a request that died before its session was saved,
+    and queues the next run for when the oldest remaining session expires.
+    """
+    ttl = current_app.config["UPLOAD_SESSION_TTL"]
+    cutoff = time.time() - ttl
+    batch_size = current_app.config["JOBS_BATCH_SIZE"]
+
+    with transaction(immediate=True):
+        expired = write_db(
+            """
+            DELETE FROM upload_sessions WHERE id IN (
+                SELECT id FROM upload_sessions WHERE created_at < datetime(?, 'unixepoch') LIMIT ?
+            )
+            RETURNING id
+            """,
+            (cutoff, batch_size),
+        )
+        for row in expired:
+            on_commit(lambda upload_id=row["id"]: discard_partial(upload_id))
+        advance(job, len(expired))
+
+    if len(expired) == batch_size:
+        return True
+
+    for upload_id in stale_partials(cutoff):
+        if query_db("SELECT 1 FROM upload_sessions WHERE id = ?", (upload_id,), single=True) is None:
+            discard_partial(upload_id)
+
+    with transaction(immediate=True):
+        oldest = query_db(
+            "SELECT CAST(strftime('%s', MIN(created_at)) AS INTEGER) AS created FROM upload_sessions",
+            single=True,
+        )
+        if oldest["created"] is not None:
+            enqueue("expire_uploads", "Expire abandoned uploads", run_at=oldest["created"] + ttl)
+    return False
+
+
+@bp.route("", methods=["POST"])
+@auth_required()
+def create(user_id: int):
+    data = request.get_json(silent=True) or {}
+    filename = data.get("filename")
+    size = data.get("size")
+
+    if not isinstance(filename, str) or not filename:
+        return _error("A filename is required.", 400)
+    if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return _error("A non-negative integer size is required.", 400)
+
+    # The partial file is allocated up front, so always bound the size.
+    max_size = current_app.config["UPLOAD_MAX_SIZE"]
+    if max_size is None or max_size > current_app.config["UPLOAD_SESSION_MAX_SIZE"]:
+        max_size = current_app.config["UPLOAD_SESSION_MAX_SIZE"]
+    if size > max_size:
+        return _error(f"File exceeds the maximum upload size of {max_size} bytes.", 413)
+
+    upload_id = secrets.token_urlsafe(16)
+    chunk_size = current_app.config["UPLOAD_SESSION_CHUNK_SIZE"]
+    try:
+        with transaction(immediate=True):
+            remaining = remaining_quota(user_id)
+            if remaining is not None:
+                # Space promised to the user's other open sessions is taken.
+                reserved = query_db(
+                    "SELECT COALESCE(SUM(size_bytes), 0) AS n FROM upload_sessions WHERE user_id = ?",
+                    (user_id,),
+                    single=True,
+                )
+                remaining = max(0, remaining - reserved["n"])
+                if size > remaining:
+                    raise QuotaExceeded(remaining)
+            session = write_db(
+                "INSERT INTO upload_sessions (id, user_id, display_name, size_bytes, chunk_size) VALUES (?, ?, ?, ?, ?) RETURNING *",
+                (upload_id, user_id, filename, size, chunk_size),
+                single=True,
+            )
+            _schedule_expiry(time.time() + current_app.config["UPLOAD_SESSION_TTL"])
+            create_partial(upload_id, size)
+    except QuotaExceeded as e:
+        return _error(f"File exceeds your remaining storage quota of {e.remaining} bytes.", 413)
+
+    return jsonify(
+        id=upload_id, chunk_size=chunk_size, chunk_count=_chunk_count(session)
+    ), 201
+
+
+@bp.route("/<upload_id>", methods=["GET"])
+@auth_required()
+def status(user_id: int, upload_id: str):
+    session = _get_session(user_id, upload_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+
+    # Collapse runs of consecutive chunk indexes into [first, last] pairs.
+    received = query_db(
+        """
+        SELECT MIN(chunk_index) AS first, MAX(chunk_index) AS last
+        FROM (
+            SELECT chunk_index, chunk_index - ROW_NUMBER() OVER (ORDER BY chunk_index) AS run
+            FROM upload_chunks WHERE session_id = ?
+        )
+        GROUP BY run ORDER BY first
+        """,
+        (upload_id,),
+    )
+
+    return jsonify(
+        id=upload_id,
+        filename=session["display_name"],
+        size=session["size_bytes"],
+        chunk_size=session["chunk_size"],
+        chunk_count=_chunk_count(session),
+        received=[[row["first"], row["last"]] for row in received],
+    )
+
+
+@bp.route("/<upload_id>/chunks/<int:index>", methods=["PUT"])
+@auth_required()
+def put_chunk(user_id: int, upload_id: str, index: int):
+    session = _get_session(user_id, upload_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+    if index >= _chunk_count(session):
+        return _error("Chunk index out of range.", 416)
+
+    offset = index * session["chunk_size"]
+    expected = min(session["chunk_size"], session["size_bytes"] - offset)
+    if request.content_length != expected:
+        return _error(f"Chunk {index} must be exactly {expected} bytes.", 400)
+
+    read_size = current_app.config["UPLOAD_CHUNK_SIZE"]
+    chunks = iter(lambda: request.stream.read(read_size), b"")
+    started = time.perf_counter()
+    try:
+        written = write_partial(upload_id, offset, chunks, expected)
+    except FileNotFoundError:
+        # `complete` took the partial file away, or the session expired.
+        return _error("Upload is being completed or has expired.", 409)
+    if written != expected:
+        return _error(f"Chunk {index} must be exactly {expected} bytes.", 400)
+    record_transfer("upload", expected, time.perf_counter() - started)
+
+    # The session may have been completed or aborted meanwhile.
+    write_db(
+        "INSERT OR IGNORE INTO upload_chunks (session_id, chunk_index) SELECT id, ? FROM upload_sessions WHERE id = ?",
+        (index, upload_id),
+    )
+    return "", 204
+
+
+@bp.route("/<upload_id>/complete", methods=["POST"])
+@auth_required()
+def complete(user_id: int, upload_id: str):
+    session = _get_session(user_id, upload_id)
+    if session is None:
+        return _error("Upload not found.", 404)
+
+    received = query_db(
+        "SELECT COUNT(*) AS n FROM upload_chunks WHERE session_id = ?",
+        (upload_id,),
+        single=True,
+    )
+    missing = _chunk_count(session) - received["n"]
+    if missing:
+        return _error(f"{missing} chunk(s) have not been received.", 409)
+
+    try:
+        received = finish_partial(upload_id)
+    except FileNotFoundError:
+        return _error("Upload is already being completed.", 409)
+    except Exception:
+        _reset(session)
+        raise
+
+    try:
+        with transaction(immediate=True):
+            check_quota(user_id, received.size_bytes)
+            stored = commit_blob(received)
+            file = write_db(
+                "INSERT INTO files (user_id, display_name, file_path, size_bytes, checksum) VALUES (?, ?, ?, ?, ?) RETURNING id",
+                (user_id, session["display_name"], stored.path, stored.size_bytes, stored.checksum),
+                single=True,
+            )
+            write_db("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+    except QuotaExceeded as e:
+        # Other uploads used up the quota since this session was created.
+        discard_received(received)
+        write_db("DELETE FROM upload_sessions WHERE id = ?", (upload_id,))
+        return _error(f"File exceeds your remaining storage quota of {e.remaining} bytes.", 413)
+    except Exception:
+        discard_received(received)
+        _reset(session)
+        raise
+
+    return jsonify(file_id=file["id"], size=stored.size_bytes, checksum=stored.checksum), 201
+
+
+def _reset(session):
+    """Start `session` over after a failed completion took its partial file.
+
+    Otherwise every later attempt would find the file gone and report the
+    upload as already being completed.
+    """
+    with transaction(immediate=True):
+        write_db("DELETE FROM upload_chunks WHERE session_id = ?", (session["id"],))
+        create_partial(session["id"], session["size_bytes"])
+
+
+@bp.route("/<upload_id>", methods=["DELETE"])
+@auth_required()
+def abort(user_id: int, upload_id: str):
+    session = write_db(
+        "DELETE FROM upload_sessions WHERE id = ? AND user_id = ? RETURNING id",
+        (upload_id, user_id),
+        single=True,
+    )
+    if session is None:
+        return _error("Upload not found.", 404)
+
+    discard_partial(upload_id)
+    return "", 204
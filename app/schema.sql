@@ -1,4 +1,8 @@
-CREATE TABLE users (
+-- Applied by `migrate_db` on every start, so every statement must be
+-- idempotent. Columns added to existing tables also need an entry in
+-- db._ADDED_COLUMNS.
+
+CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
     password_hash TEXT NOT NULL,
@@ -6,14 +10,132 @@ CREATE TABLE users (
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE TABLE files (
+CREATE TABLE IF NOT EXISTS files (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
     display_name TEXT NOT NULL,
     size_bytes INTEGER NOT NULL,
     file_path TEXT NOT NULL,
+    checksum TEXT,
     uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX idx_files_user_id ON files(user_id);
+CREATE INDEX IF NOT EXISTS idx_files_user_name ON files(user_id, display_name, id);
+CREATE INDEX IF NOT EXISTS idx_files_user_size ON files(user_id, size_bytes, id);
+CREATE INDEX IF NOT EXISTS idx_files_user_uploaded ON files(user_id, uploaded_at, id);
+CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at, id);
+
+CREATE TABLE IF NOT EXISTS refresh_tokens (
+    token_hash BLOB PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+    created_at INTEGER NOT NULL,
+    expires_at INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id);
+CREATE INDEX IF NOT EXISTS idx_refresh_tokens_expires ON refresh_tokens(expires_at);
+
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    jti TEXT UNIQUE NOT NULL,
+    expires_at INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires ON revoked_tokens(expires_at);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    codec TEXT,
+    stored_size INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_insert AFTER INSERT ON files BEGIN
+    UPDATE blobs SET refcount = refcount + 1 WHERE path = NEW.file_path;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_delete AFTER DELETE ON files BEGIN
+    UPDATE blobs SET refcount = refcount - 1 WHERE path = OLD.file_path;
+END;
+
+CREATE TRIGGER IF NOT EXISTS blobs_ref_update AFTER UPDATE OF file_path ON files BEGIN
+    UPDATE blobs SET refcount = refcount - 1 WHERE path = OLD.file_path;
+    UPDATE blobs SET refcount = refcount + 1 WHERE path = NEW.file_path;
+END;
+
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_id INTEGER PRIMARY KEY REFERENCES users ON DELETE CASCADE,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    bytes_used INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS user_usage_create AFTER INSERT ON users BEGIN
+    INSERT INTO user_usage (user_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_usage_insert AFTER INSERT ON files BEGIN
+    UPDATE user_usage SET file_count = file_count + 1, bytes_used = bytes_used + NEW.size_bytes
+    WHERE user_id = NEW.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_usage_delete AFTER DELETE ON files BEGIN
+    UPDATE user_usage SET file_count = file_count - 1, bytes_used = bytes_used - OLD.size_bytes
+    WHERE user_id = OLD.user_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS user_usage_update AFTER UPDATE OF user_id, size_bytes ON files BEGIN
+    UPDATE user_usage SET file_count = file_count - 1, bytes_used = bytes_used - OLD.size_bytes
+    WHERE user_id = OLD.user_id;
+    UPDATE user_usage SET file_count = file_count + 1, bytes_used = bytes_used + NEW.size_bytes
+    WHERE user_id = NEW.user_id;
+END;
+
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+    display_name TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions(user_id);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_created ON upload_sessions(created_at);
+
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    session_id TEXT NOT NULL REFERENCES upload_sessions ON DELETE CASCADE,
+    chunk_index INTEGER NOT NULL,
+    PRIMARY KEY (session_id, chunk_index)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    label TEXT NOT NULL,
+    payload TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    finished_at REAL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_at, id);
+
+CREATE TABLE IF NOT EXISTS job_paths (
+    job_id INTEGER NOT NULL REFERENCES jobs ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    PRIMARY KEY (job_id, path)
+) WITHOUT ROWID;
 
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
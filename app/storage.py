@@ -0,0 +1,498 @@
+"""Content-addressed storage for uploaded files.
+
+Uploads are streamed to a temporary file under FILE_STORE while being
+hashed, then stored once under their SHA-256 digest. The `blobs` table
+tracks how many `files` rows point at each blob; triggers in schema.sql
+keep the count current, including for cascaded deletes.
+
+With FILE_STORE_COMPRESSION set, compressible uploads are compressed as
+they are written; the blob records the codec and the size on disk, while
+`size_bytes` stays the original size everywhere.
+
+Per-user totals live in `user_usage`, also maintained by triggers, so
+USER_QUOTA_BYTES can be checked without summing a user's files.
+
+Blobs are sharded into FILE_STORE_SHARD_DEPTH levels of directories named
+after FILE_STORE_SHARD_WIDTH-character prefixes of the digest. Files
+uploaded before the content-addressed layout keep their flat
+`{token}_{filename}` paths and have no `blobs` row until the
+`rebalance-store` command moves them over. Every path is stored relative
+to FILE_STORE, so lookups work the same for all layouts.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import sqlite3
+import time
+from collections.abc import Iterable
+from typing import BinaryIO, NamedTuple
+
+import click
+from flask import Flask, current_app
+
+from app.compression import (
+    SAMPLE_SIZE,
+    check_codec,
+    compressor,
+    open_decompressed,
+    worth_compressing,
+)
+from app.db import on_commit, query_db, transaction, write_db
+from app.jobs import advance, job
+
+
+class UploadTooLarge(Exception):
+    """Raised when streamed content exceeds the configured size limit."""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Upload exceeds the limit of {limit} bytes")
+        self.limit = limit
+
+
+class QuotaExceeded(Exception):
+    """Raised when a file would take its owner past USER_QUOTA_BYTES."""
+
+    def __init__(self, remaining: int):
+        super().__init__(f"Upload exceeds the remaining quota of {remaining} bytes")
+        self.remaining = remaining
+
+
+class StoredFile(NamedTuple):
+    path: str
+    """Location relative to FILE_STORE."""
+    size_bytes: int
+    checksum: str
+    """Hex SHA-256 digest of the content."""
+    codec: str | None = None
+    """Compression applied on disk, if any."""
+
+
+def _full_path(path: str) -> str:
+    return os.path.join(current_app.config["FILE_STORE"], path)
+
+
+def blob_path(digest: str) -> str:
+    depth = current_app.config["FILE_STORE_SHARD_DEPTH"]
+    width = current_app.config["FILE_STORE_SHARD_WIDTH"]
+    shards = [digest[i * width : (i + 1) * width] for i in range(depth)]
+    return os.path.join(*shards, digest)
+
+
+def _temp_path() -> str:
+    temp_dir = _full_path(".tmp")
+    os.makedirs(temp_dir, exist_ok=True)
+    return os.path.join(temp_dir, secrets.token_hex(16))
+
+
+def receive_chunks(
+    chunks: Iterable[bytes], max_size: int | None = None, compress: bool = True
+) -> StoredFile:
+    """Write `chunks` to a temporary file, hashing and counting as we go.
+
+    With `compress` and FILE_STORE_COMPRESSION set, the content is
+    compressed on the way to disk if a sample of it compresses well.
+    The returned file must be handed to `commit_blob`. A partially written
+    file is removed if the stream fails or grows past `max_size`.
+    """
+    codec = current_app.config["FILE_STORE_COMPRESSION"] if compress else None
+    temp_path = _temp_path()
+    digest = hashlib.sha256()
+    size = 0
+    # Held back until there is enough to judge compressibility.
+    sample = bytearray() if codec else None
+    encoder = None
+
+    def start(f):
+        nonlocal encoder, sample
+        if worth_compressing(bytes(sample[:SAMPLE_SIZE])):
+            encoder = compressor(codec, current_app.config["FILE_STORE_COMPRESSION_LEVEL"])
+            f.write(encoder.compress(bytes(sample)))
+        else:
+            f.write(sample)
+        sample = None
+
+    with open(temp_path, "xb") as f:
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise UploadTooLarge(max_size)
+                digest.update(chunk)
+                if sample is not None:
+                    sample.extend(chunk)
+                    if len(sample) >= SAMPLE_SIZE:
+                        start(f)
+                elif encoder is not None:
+                    f.write(encoder.compress(chunk))
+                else:
+                    f.write(chunk)
+
+            if sample is not None:
+                start(f)
+            if encoder is not None:
+                f.write(encoder.flush())
+        except BaseException:
+            f.close()
+            os.remove(temp_path)
+            raise
+
+    return StoredFile(temp_path, size, digest.hexdigest(), codec if encoder else None)
+
+
+def commit_blob(received: StoredFile) -> StoredFile:
+    """Move received content into the store, or drop it if already stored.
+
+    Must run inside `transaction(immediate=True)` so it is serialized with
+    `release_file`; the caller then inserts the `files` row that takes the
+    reference.
+    """
+    path = blob_path(received.checksum)
+    write_db(
+        "INSERT INTO blobs (digest, path, size_bytes, codec, stored_size) VALUES (?, ?, ?, ?, ?) ON CONFLICT (digest) DO NOTHING",
+        (
+            received.checksum,
+            path,
+            received.size_bytes,
+            received.codec,
+            os.path.getsize(received.path),
+        ),
+    )
+    blob = query_db(
+        "SELECT path, codec FROM blobs WHERE digest = ?", (received.checksum,), single=True
+    )
+    full_path = _full_path(blob["path"])
+
+    if os.path.exists(full_path):
+        os.remove(received.path)
+    else:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        os.replace(received.path, full_path)
+
+    return StoredFile(blob["path"], received.size_bytes, received.checksum, blob["codec"])
+
+
+def discard_received(received: StoredFile):
+    """Drop content from `receive_chunks` that will not be committed."""
+    try:
+        os.remove(received.path)
+    except FileNotFoundError:
+        pass
+
+
+def get_usage(user_id: int) -> sqlite3.Row | None:
+    return query_db(
+        "SELECT file_count, bytes_used FROM user_usage WHERE user_id = ?", (user_id,), single=True
+    )
+
+
+def remaining_quota(user_id: int) -> int | None:
+    """Bytes `user_id` may still store, or None if quotas are disabled."""
+    quota = current_app.config["USER_QUOTA_BYTES"]
+    if quota is None:
+        return None
+    usage = get_usage(user_id)
+    return max(0, quota - (usage["bytes_used"] if usage else 0))
+
+
+def check_quota(user_id: int, size: int):
+    """Raise `QuotaExceeded` if `user_id` cannot store `size` more bytes.
+
+    Call inside the `transaction(immediate=True)` that inserts the file, so
+    concurrent uploads cannot both pass the check.
+    """
+    remaining = remaining_quota(user_id)
+    if remaining is not None and size > remaining:
+        raise QuotaExceeded(remaining)
+
+
+def release_file(path: str):
+    """Delete a file's content once no `files` row references it.
+
+    Call inside `transaction(immediate=True)` after deleting the rows. The
+    content is only unlinked once that transaction commits.
+    """
+    blob = query_db("SELECT refcount FROM blobs WHERE path = ?", (path,), single=True)
+
+    if blob is not None:
+        if blob["refcount"] > 0:
+            return
+        write_db("DELETE FROM blobs WHERE path = ?", (path,))
+
+    # Move the content aside under the write lock, so an upload of the same
+    # content committed right after us lands on a fresh file, not this one.
+    full_path = _full_path(path)
+    released = f"{full_path}.released-{secrets.token_hex(4)}"
+    try:
+        os.rename(full_path, released)
+    except FileNotFoundError:
+        return
+    on_commit(lambda: os.remove(released), undo=lambda: os.replace(released, full_path))
+
+
+def open_stored(full_path: str, codec: str | None) -> BinaryIO:
+    """Open a stored file for reading its original, uncompressed content."""
+    return open(full_path, "rb") if codec is None else open_decompressed(full_path, codec)
+
+
+def checksum_file(full_path: str) -> tuple[int, str]:
+    """Return the size and hex SHA-256 digest of a file on disk."""
+    chunk_size = current_app.config["UPLOAD_CHUNK_SIZE"]
+    digest = hashlib.sha256()
+    size = 0
+
+    with open(full_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return size, digest.hexdigest()
+
+
+def _partial_path(upload_id: str) -> str:
+    return _full_path(os.path.join(".partial", upload_id))
+
+
+def create_partial(upload_id: str, size: int):
+    """Reserve a sparse file of `size` bytes for a resumable upload."""
+    os.makedirs(os.path.dirname(_partial_path(upload_id)), exist_ok=True)
+    with open(_partial_path(upload_id), "xb") as f:
+        f.truncate(size)
+
+
+def write_partial(
+    upload_id: str, offset: int, chunks: Iterable[bytes], length: int
+) -> int:
+    """Write at most `length` bytes from `chunks` at `offset`.
+
+    Returns the number of bytes that were available, which the caller
+    compares against `length` to detect truncated chunks.
+    """
+    written = 0
+    with open(_partial_path(upload_id), "r+b") as f:
+        f.seek(offset)
+        for chunk in chunks:
+            written += len(chunk)
+            if written > length:
+                break
+            f.write(chunk)
+    return written
+
+
+def compress_received(received: StoredFile) -> StoredFile:
+    """Give content received with `compress=False` the usual compression."""
+    if received.codec is not None or not current_app.config["FILE_STORE_COMPRESSION"]:
+        return received
+    chunk_size = current_app.config["UPLOAD_CHUNK_SIZE"]
+
+    try:
+        with open(received.path, "rb") as f:
+            return receive_chunks(iter(lambda: f.read(chunk_size), b""))
+    finally:
+        os.remove(received.path)
+
+
+def finish_partial(upload_id: str) -> StoredFile:
+    """Checksum (and maybe compress) a completed resumable upload for `commit_blob`.
+
+    Raises FileNotFoundError if another request is already finishing it.
+    """
+    partial_path = _temp_path()
+    os.rename(_partial_path(upload_id), partial_path)
+    chunk_size = current_app.config["UPLOAD_CHUNK_SIZE"]
+
+    try:
+        with open(partial_path, "rb") as f:
+            return receive_chunks(iter(lambda: f.read(chunk_size), b""))
+    finally:
+        os.remove(partial_path)
+
+
+def discard_partial(upload_id: str):
+    try:
+        os.remove(_partial_path(upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def stale_partials(before: float) -> list[str]:
+    """Ids of the partial uploads last written before `before`."""
+    try:
+        entries = list(os.scandir(_full_path(".partial")))
+    except FileNotFoundError:
+        return []
+    return [entry.name for entry in entries if entry.stat().st_mtime < before]
+
+
+@job("reclaim_files")
+def reclaim_files(job: sqlite3.Row) -> bool:
+    """Release a batch of a deleted user's paths and partial uploads.
+
+    The paths are queued in `job_paths` by `admin.delete_user`. Releasing
+    is idempotent, so a batch that is retried after a crash is harmless.
+    """
+    with transaction(immediate=True):
+        rows = query_db(
+            "SELECT path FROM job_paths WHERE job_id = ? LIMIT ?",
+            (job["id"], current_app.config["JOBS_BATCH_SIZE"]),
+        )
+        for row in rows:
+            release_file(row["path"])
+            write_db("DELETE FROM job_paths WHERE job_id = ? AND path = ?", (job["id"], row["path"]))
+        advance(job, len(rows))
+
+    if rows:
+        return True
+
+    for upload_id in json.loads(job["payload"]).get("uploads", []):
+        discard_partial(upload_id)
+    return False
+
+
+def _link(old_path: str, new_path: str) -> bool:
+    """Hard-link `old_path` to `new_path`; False if the target already exists."""
+    full_path = _full_path(new_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    try:
+        os.link(_full_path(old_path), full_path)
+    except FileExistsError:
+        return False
+    return True
+
+
+def _relocate(moves: list[tuple[str, str, str, int]]) -> int:
+    """Point files and blobs at new paths, one transaction per batch.
+
+    Each move is (old path, new path, digest, size). Content is hard-linked
+    into its new location first, so downloads of the old path keep working
+    until the transaction commits; the old names are unlinked afterwards.
+    A move whose old path disappeared meanwhile is skipped.
+    """
+    linked = []
+    moved = []
+    unused = []
+
+    try:
+        ready = []
+        for move in moves:
+            old_path, new_path, _, _ = move
+            try:
+                if _link(old_path, new_path):
+                    linked.append(new_path)
+            except FileNotFoundError:
+                continue  # Deleted while we were rebalancing.
+            ready.append(move)
+
+        with transaction(immediate=True):
+            for old_path, new_path, digest, size in ready:
+                blob = query_db("SELECT path FROM blobs WHERE digest = ?", (digest,), single=True)
+                if blob is None:
+                    target = new_path
+                    write_db(
+                        "INSERT INTO blobs (digest, path, size_bytes, stored_size) VALUES (?, ?, ?, ?)",
+                        (digest, target, size, size),
+                    )
+                elif blob["path"] == old_path:
+                    target = new_path
+                    write_db("UPDATE blobs SET path = ? WHERE digest = ?", (target, digest))
+                else:
+                    # The content is already stored as another blob: share it
+                    # rather than pull that blob away from its own files.
+                    target = blob["path"]
+                    if new_path in linked:
+                        unused.append(new_path)
+
+                write_db(
+                    "UPDATE files SET file_path = ?, checksum = ? WHERE file_path = ?",
+                    (target, digest, old_path),
+                )
+                # The path-keyed triggers cannot follow a blob that changes
+                # path, so recount its references directly.
+                write_db(
+                    "UPDATE blobs SET refcount = (SELECT COUNT(*) FROM files WHERE file_path = ?) WHERE digest = ?",
+                    (target, digest),
+                )
+                # Drops the blob again if its files were deleted meanwhile.
+                release_file(target)
+                moved.append(old_path)
+    except BaseException:
+        for new_path in linked:
+            try:
+                os.remove(_full_path(new_path))
+            except FileNotFoundError:
+                pass
+        raise
+
+    for path in moved + unused:
+        try:
+            os.remove(_full_path(path))
+        except FileNotFoundError:
+            pass
+
+    return len(moved)
+
+
+def rebalance_store(batch_size: int = 100, pause: float = 0.0) -> int:
+    """Move flat files and misplaced blobs into the configured layout.
+
+    Safe to run while the app is serving requests. Returns the number of
+    paths moved.
+    """
+    total = 0
+
+    last_id = 0
+    while True:
+        rows = query_db(
+            "SELECT id, file_path FROM files WHERE id > ? AND file_path NOT IN (SELECT path FROM blobs) ORDER BY id LIMIT ?",
+            (last_id, batch_size),
+        )
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+
+        moves = []
+        for row in rows:
+            if not os.path.isfile(_full_path(row["file_path"])):
+                click.echo(f"Skipping missing file {row['file_path']}", err=True)
+                continue
+            size, digest = checksum_file(_full_path(row["file_path"]))
+            moves.append((row["file_path"], blob_path(digest), digest, size))
+
+        total += _relocate(moves)
+        time.sleep(pause)
+
+    last_digest = ""
+    while True:
+        rows = query_db(
+            "SELECT digest, path, size_bytes FROM blobs WHERE digest > ? ORDER BY digest LIMIT ?",
+            (last_digest, batch_size),
+        )
+        if not rows:
+            break
+        last_digest = rows[-1]["digest"]
+
+        moves = [
+            (row["path"], blob_path(row["digest"]), row["digest"], row["size_bytes"])
+            for row in rows
+            if row["path"] != blob_path(row["digest"])
+        ]
+        if moves:
+            total += _relocate(moves)
+            time.sleep(pause)
+
+    return total
+
+
+@click.command("rebalance-store")
+@click.option("--batch-size", default=100, show_default=True, help="Files moved per transaction.")
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+def rebalance_store_command(batch_size: int, pause: float):
+    """Move flat and misplaced files into the sharded FILE_STORE layout."""
+    moved = rebalance_store(batch_size, pause)
+    click.echo(f"Moved {moved} file(s).")
+
+
+def init_app(app: Flask):
+    check_codec(app.config["FILE_STORE_COMPRESSION"])
+    app.cli.add_command(rebalance_store_command)
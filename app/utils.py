@@ -1,3 +1,9 @@
+from flask import Response, current_app, get_flashed_messages, stream_with_context
+
+# Template output events gathered before each write to the client.
+STREAM_BUFFER_EVENTS = 64
+
+
 def format_size(size_bytes: int) -> str:
     """Format file size in bytes to a human-readable string."""
     if size_bytes == 0:
@@ -12,3 +18,21 @@ def format_size(size_bytes: int) -> str:
         i += 1
 
     return f"{size:.2f} {size_name[i]}"
+
+
+def stream_page(template_name: str, **context) -> Response:
+    """Render a template incrementally so the first bytes go out right away.
+
+    Rows passed in as lazy iterators are pulled from the database while the
+    response is being sent, keeping memory flat for long listings.
+    """
+    # Pop flashed messages now: once streaming starts, the session cookie
+    # has already been sent and could no longer be updated.
+    get_flashed_messages()
+
+    app = current_app._get_current_object()
+    template = app.jinja_env.get_or_select_template(template_name)
+    app.update_template_context(context)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER_EVENTS)
+    return app.response_class(stream_with_context(stream), mimetype="text/html")
@@ -0,0 +1,122 @@
+"""Measure dashboard latency on the old and the pooled read path.
+
+    $ python -m benchmarks.bench_dashboard --requests 500 --files 200
+
+`legacy` reproduces the old get_db, which opened a new connection for
+every request and closed it at teardown. Its commit() after every
+statement cost nothing for SELECTs, which never open a transaction, so
+it is not reproduced. `current` is the read path as shipped.
+"""
+
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db
+from app.db import connect, get_db, init_db, query_db
+
+
+class Reconnect:
+    """Stands in for the pool, connecting afresh on every checkout."""
+
+    def __init__(self, database: str):
+        self.database = database
+
+    def acquire(self):
+        return connect(self.database, {})
+
+    def release(self, conn):
+        conn.close()
+
+
+@contextmanager
+def legacy_reads(app):
+    # get_db looks the pool up through the module, which covers every
+    # view, query_db and the iter_db behind pagination alike.
+    reconnect = Reconnect(app.config["DATABASE"])
+    get_pool = db.get_pool
+    db.get_pool = lambda: reconnect
+    try:
+        yield
+    finally:
+        db.get_pool = get_pool
+
+
+def seed(app, file_count: int):
+    with app.app_context():
+        init_db()
+        user = query_db(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id",
+            ("bench user", generate_password_hash("password")),
+            single=True,
+        )
+        get_db().executemany(
+            "INSERT INTO files (user_id, display_name, file_path, size_bytes) VALUES (?, ?, ?, ?)",
+            [(user["id"], f"file {i}.txt", f"file_{i}.txt", i) for i in range(file_count)],
+        )
+        get_db().commit()
+
+
+def measure(client, path: str, count: int) -> list[float]:
+    for _ in range(max(count // 10, 1)):
+        client.get(path)
+    timings = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = client.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+    return timings
+
+
+def summarize(timings: list[float]) -> str:
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    return f"p50 {statistics.median(timings):7.3f} ms  p95 {p95:7.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--files", type=int, default=100)
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    # The access log and metrics flush from atexit handlers registered
+    # later, which run first.
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    app = create_app(
+        {
+            "DATABASE": os.path.join(workdir, "bench.sqlite"),
+            "FILE_STORE": os.path.join(workdir, "files"),
+            "ACCESS_LOG": os.path.join(workdir, "access.log"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+        }
+    )
+    seed(app, options.files)
+
+    endpoints = {
+        "/dashboard/": ("bench user", "password"),
+        "/admin/": ("default admin", "password"),
+    }
+    for path, (username, password) in endpoints.items():
+        client = app.test_client()
+        client.post("/login", data={"username": username, "password": password})
+
+        with legacy_reads(app):
+            legacy = measure(client, path, options.requests)
+        current = measure(client, path, options.requests)
+
+        print(f"{path:<12} legacy   {summarize(legacy)}")
+        print(f"{path:<12} current  {summarize(current)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""Drive the main user journeys against gunicorn and report JSON results.
+
+    $ python -m benchmarks.bench_load --clients 16 --duration 30 \
+        --mix login=1,dashboard=6,upload=2,download=3,delete=1 > before.json
+
+Starts gunicorn from `create_app` on a scratch database seeded with
+`--users` accounts. Each client is an asyncio task with its own
+keep-alive connection. It logs in once, then picks operations at random
+according to `--mix`. It only downloads or deletes files it has uploaded
+itself, so the file count stays roughly steady. Rate limits are turned
+off unless `--rate-limits` is given, because every client shares one IP.
+
+The report has throughput, error counts and latency percentiles (ms) for
+each operation and for the whole run, plus the options and git revision,
+so runs from two releases can be diffed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from app import create_app
+from app.db import get_db, init_db
+from app.passwords import hash_passwords
+
+OPERATIONS = ("login", "dashboard", "upload", "download", "delete")
+DEFAULT_MIX = "login=1,dashboard=6,upload=2,download=3,delete=1"
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}")
+        mix[name] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("mix needs at least one positive weight")
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed(config: dict, users: int):
+    app = create_app(config)
+    with app.app_context():
+        init_db()
+        hashes = hash_passwords(["password"] * users)
+        get_db().executemany(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+            [(f"user{i}", password_hash) for i, password_hash in enumerate(hashes)],
+        )
+        get_db().commit()
+
+
+def wait_for(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Connection:
+    """A minimal keep-alive HTTP/1.1 client that tracks cookies."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.cookies: dict[str, str] = {}
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+
+    async def request(
+        self, method: str, path: str, body: bytes = b"", headers: dict | None = None
+    ) -> tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+        lines = [f"{method} {path} HTTP/1.1", f"Host: 127.0.0.1:{self.port}"]
+        if self.cookies:
+            lines.append("Cookie: " + "; ".join(f"{k}={v}" for k, v in self.cookies.items()))
+        if body or method == "POST":
+            lines.append(f"Content-Length: {len(body)}")
+        lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await self.writer.drain()
+
+        try:
+            return await self._read_response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise
+
+    async def _read_response(self) -> tuple[int, bytes]:
+        status_line = await self.reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers: list[tuple[str, str]] = []
+        while (line := await self.reader.readuntil(b"\r\n")) != b"\r\n":
+            name, _, value = line.decode("latin-1").partition(":")
+            headers.append((name.strip().lower(), value.strip()))
+
+        for name, value in headers:
+            if name == "set-cookie":
+                key, _, rest = value.partition("=")
+                cookie, _, attributes = rest.partition(";")
+                if "max-age=0" in attributes.lower() or "expires=thu, 01 jan 1970" in attributes.lower():
+                    self.cookies.pop(key, None)
+                else:
+                    self.cookies[key] = cookie
+
+        fields = dict(headers)
+        if fields.get("transfer-encoding", "").lower() == "chunked":
+            body = bytearray()
+            while size := int((await self.reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                body += await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+            while await self.reader.readuntil(b"\r\n") != b"\r\n":
+                pass  # Trailers.
+        else:
+            body = await self.reader.readexactly(int(fields.get("content-length", 0)))
+
+        if fields.get("connection", "").lower() == "close":
+            self.close()
+        return status, bytes(body)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class Client:
+    """One simulated user working through the configured mix."""
+
+    def __init__(self, conn: Connection, username: str, upload_size: int, rng: random.Random):
+        self.conn = conn
+        self.username = username
+        self.upload_size = upload_size
+        self.rng = rng
+        self.file_ids: list[int] = []
+
+    async def login(self) -> bool:
+        body = urlencode({"username": self.username, "password": "password"}).encode()
+        status, _ = await self.conn.request(
+            "POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        return status == 302 and "access_token" in self.conn.cookies
+
+    async def dashboard(self) -> bool:
+        status, _ = await self.conn.request("GET", "/dashboard/")
+        return status == 200
+
+    async def upload(self) -> bool:
+        boundary = f"bench{self.rng.getrandbits(64):016x}"
+        content = self.rng.randbytes(self.upload_size)
+        name = f"bench-{self.rng.getrandbits(32):08x}.bin"
+        body = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+        status, payload = await self.conn.request(
+            "POST",
+            "/dashboard/upload",
+            body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}", "Accept": "application/json"},
+        )
+        if status != 200:
+            return False
+        results = json.loads(payload)["results"]
+        self.file_ids += [result["id"] for result in results if "id" in result]
+        return all("id" in result for result in results)
+
+    async def download(self) -> bool:
+        status, _ = await self.conn.request(
+            "GET", f"/dashboard/download/{self.rng.choice(self.file_ids)}"
+        )
+        return status == 200
+
+    async def delete(self) -> bool:
+        file_id = self.file_ids.pop(self.rng.randrange(len(self.file_ids)))
+        status, _ = await self.conn.request("POST", f"/dashboard/delete/{file_id}")
+        return status == 302
+
+
+def summarize(samples: list[float], errors: int, duration: float) -> dict:
+    samples = sorted(samples)
+    quantile = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))], 2)
+    count = len(samples)
+    summary = {
+        "requests": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "throughput": round(count / duration, 2),
+    }
+    if samples:
+        summary["latency_ms"] = {
+            "mean": round(sum(samples) / count, 2),
+            "p50": quantile(0.50),
+            "p90": quantile(0.90),
+            "p95": quantile(0.95),
+            "p99": quantile(0.99),
+            "max": round(samples[-1], 2),
+        }
+    return summary
+
+
+async def drive(port: int, options) -> dict:
+    names = list(options.mix)
+    weights = [options.mix[name] for name in names]
+    latencies: dict[str, list[float]] = {name: [] for name in OPERATIONS}
+    errors: dict[str, int] = dict.fromkeys(OPERATIONS, 0)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    measure_from = started + options.warmup
+    stop_at = measure_from + options.duration
+
+    async def run_client(n: int):
+        rng = random.Random(options.seed * 100003 + n)
+        conn = Connection(port)
+        client = Client(conn, f"user{n % options.users}", options.upload_size, rng)
+        try:
+            await client.login()
+            while (now := loop.time()) < stop_at:
+                name = rng.choices(names, weights)[0]
+                if name in ("download", "delete") and not client.file_ids:
+                    name = "upload"
+
+                begin = time.perf_counter()
+                try:
+                    ok = await getattr(client, name)()
+                except (OSError, asyncio.IncompleteReadError, ValueError, KeyError):
+                    ok = False
+                elapsed = (time.perf_counter() - begin) * 1000
+
+                if now >= measure_from:
+                    latencies[name].append(elapsed)
+                    errors[name] += not ok
+                if not ok and "access_token" not in conn.cookies:
+                    await client.login()
+        finally:
+            conn.close()
+
+    await asyncio.gather(*(run_client(n) for n in range(options.clients)))
+
+    operations = {
+        name: summarize(latencies[name], errors[name], options.duration)
+        for name in OPERATIONS
+        if latencies[name]
+    }
+    overall = summarize(
+        [sample for samples in latencies.values() for sample in samples],
+        sum(errors.values()),
+        options.duration,
+    )
+    return {"overall": overall, "operations": operations}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds.")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds before measuring.")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--upload-size", type=int, default=64 * 1024, help="Bytes per upload.")
+    parser.add_argument("--seed", type=int, default=0)
+    # The server defaults match the Dockerfile, so a plain run measures the
+    # deployed setup.
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the default rate limits.")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        config = {
+            "DATABASE": os.path.join(workdir, "bench.sqlite"),
+            "FILE_STORE": os.path.join(workdir, "files"),
+            # Keep the run's logs and metric snapshots out of instance/.
+            "ACCESS_LOG": os.path.join(workdir, "access.log"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+            "WEB_WORKERS": options.workers,
+        }
+        if not options.rate_limits:
+            config.update(
+                RATE_LIMIT_LOGIN_IP=None, RATE_LIMIT_LOGIN_USERNAME=None, RATE_LIMIT_UPLOAD=None
+            )
+        seed(config, options.users)
+
+        port = free_port()
+        server = subprocess.Popen(
+            [
+                sys.executable, "-m", "gunicorn",
+                "--workers", str(options.workers),
+                "--worker-class", options.worker_class,
+                "--threads", str(options.threads),
+                "--bind", f"127.0.0.1:{port}",
+                "--log-level", "warning",
+                f"app:create_app({config!r})",
+            ]
+        )
+        try:
+            wait_for(port)
+            results = asyncio.run(drive(port, options))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "options": {
+            key: value for key, value in vars(options).items() if key != "output"
+        },
+        **results,
+    }
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Measure login throughput and dashboard latency under a mixed load.
+
+    $ python -m benchmarks.bench_login --duration 20 --login-clients 8
+
+Runs the app under gunicorn twice, once hashing inline
+(PASSWORD_HASH_WORKERS=0) and once through the hashing pool, each on a
+fresh database with the login rate limits off. Each run has clients
+posting logins in a loop while other clients browse the dashboard. Reports logins per second and the dashboard latency
+percentiles.
+"""
+
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from app import create_app
+from app.db import get_db, init_db
+from app.passwords import hash_passwords
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def seed(config: dict, users: int):
+    app = create_app(config)
+    with app.app_context():
+        init_db()
+        hashes = hash_passwords(["password"] * users)
+        get_db().executemany(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+            [(f"user{i}", password_hash) for i, password_hash in enumerate(hashes)],
+        )
+        get_db().commit()
+
+
+def wait_for(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not start")
+
+
+def login(conn: http.client.HTTPConnection, username: str) -> http.client.HTTPResponse:
+    body = urlencode({"username": username, "password": "password"})
+    conn.request(
+        "POST", "/login", body, {"Content-Type": "application/x-www-form-urlencoded"}
+    )
+    response = conn.getresponse()
+    response.read()
+    return response
+
+
+def run(label: str, overrides: dict, options) -> None:
+    workdir = tempfile.mkdtemp()
+    try:
+        config = {
+            "DATABASE": os.path.join(workdir, "bench.sqlite"),
+            "FILE_STORE": os.path.join(workdir, "files"),
+            "ACCESS_LOG": os.path.join(workdir, "access.log"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+            # Every client logs in from one IP, over and over.
+            "RATE_LIMIT_LOGIN_IP": None,
+            "RATE_LIMIT_LOGIN_USERNAME": None,
+            **overrides,
+        }
+        seed(config, options.users)
+        serve(label, config, options)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def serve(label: str, config: dict, options) -> None:
+    port = free_port()
+    factory = f"app:create_app({config!r})"
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "--workers", str(options.workers),
+            "--worker-class", options.worker_class,
+            "--threads", str(options.threads),
+            "--bind", f"127.0.0.1:{port}",
+            "--log-level", "warning",
+            factory,
+        ]
+    )
+    try:
+        wait_for(port)
+        stop = threading.Event()
+        logins: list[int] = []
+        latencies: list[float] = []
+
+        def login_client(n: int):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            count = 0
+            while not stop.is_set():
+                if login(conn, f"user{n % options.users}").status == 302:
+                    count += 1
+            logins.append(count)
+
+        def browse_client(n: int):
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            cookie = login(conn, f"user{n % options.users}").getheader("Set-Cookie").split(";")[0]
+            while not stop.is_set():
+                started = time.perf_counter()
+                conn.request("GET", "/dashboard/", headers={"Cookie": cookie})
+                conn.getresponse().read()
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        threads = [
+            threading.Thread(target=login_client, args=(n,)) for n in range(options.login_clients)
+        ] + [
+            threading.Thread(target=browse_client, args=(n,)) for n in range(options.browse_clients)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(options.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    quantile = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    print(
+        f"{label:<7} logins {sum(logins) / options.duration:7.1f}/s  "
+        f"dashboard p50 {statistics.median(latencies):7.1f} ms  "
+        f"p95 {quantile(0.95):7.1f} ms  p99 {quantile(0.99):7.1f} ms  "
+        f"({len(latencies)} requests)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--login-clients", type=int, default=8)
+    parser.add_argument("--browse-clients", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--hash-workers", type=int, default=None, help="Pool processes per worker.")
+    parser.add_argument("--hash-concurrency", type=int, default=None)
+    options = parser.parse_args()
+
+    run("inline", {"PASSWORD_HASH_WORKERS": 0}, options)
+    run(
+        "pool",
+        {
+            "WEB_WORKERS": options.workers,
+            "PASSWORD_HASH_WORKERS": options.hash_workers,
+            "PASSWORD_HASH_CONCURRENCY": options.hash_concurrency,
+        },
+        options,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Compare user provisioning throughput: one form POST per user vs. bulk.
+
+    $ python -m benchmarks.bench_provisioning --users 500
+
+`single` posts every account to /admin/create_user; `bulk` sends them all
+to /admin/users/bulk in one request. Run it on a multi-core machine to see
+the effect of the hashing pool (PASSWORD_HASH_WORKERS defaults to the CPU
+count).
+"""
+
+import argparse
+import atexit
+import os
+import shutil
+import tempfile
+import time
+
+from app import create_app
+from app.db import init_db
+
+
+def run(label: str, users: int, workers: int | None, provision) -> float:
+    workdir = tempfile.mkdtemp()
+    # The access log and metrics flush from atexit handlers registered
+    # later, which run first.
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    app = create_app(
+        {
+            "DATABASE": os.path.join(workdir, "bench.sqlite"),
+            "FILE_STORE": os.path.join(workdir, "files"),
+            "ACCESS_LOG": os.path.join(workdir, "access.log"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+            "PASSWORD_HASH_WORKERS": workers,
+        }
+    )
+    with app.app_context():
+        init_db()
+
+    client = app.test_client()
+    client.post("/login", data={"username": "default admin", "password": "password"})
+    records = [{"username": f"{label}{i}", "password": f"password{i}"} for i in range(users)]
+
+    start = time.perf_counter()
+    provision(client, records)
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<8} {users / elapsed:8.1f} users/s  ({elapsed:.2f} s)")
+    return elapsed
+
+
+def provision_single(client, records):
+    for record in records:
+        response = client.post("/admin/create_user", data=record)
+        assert response.status_code == 302, response.status_code
+
+
+def provision_bulk(client, records):
+    response = client.post("/admin/users/bulk", json=records)
+    assert response.get_json()["failed"] == 0, response.get_json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=None, help="Hashing processes for bulk.")
+    options = parser.parse_args()
+
+    single = run("single", options.users, options.workers, provision_single)
+    bulk = run("bulk", options.users, options.workers, provision_bulk)
+    print(f"speedup  {single / bulk:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
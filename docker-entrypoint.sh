@@ -0,0 +1,23 @@
+#!/bin/bash
+# Run the background job worker next to the web server. Deleting a user
+# only queues the removal of their files; `flask run-worker` does it.
+# Arguments are passed to gunicorn.
+
+# The instance volume outlives images: bring its schema up to date first.
+flask migrate-db || exit 1
+
+flask run-worker &
+worker=$!
+
+gunicorn "$@" &
+web=$!
+
+# docker stop sends SIGTERM: pass it on so the worker finishes its batch.
+trap 'kill -TERM "$web" "$worker" 2>/dev/null' TERM INT
+
+# If either process exits, stop the other and let the container restart.
+wait -n
+status=$?
+kill -TERM "$web" "$worker" 2>/dev/null
+wait
+exit "$status"
@@ -14,7 +14,7 @@ from app.db import init_db, query_db
 
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     db_fd, db_path = tempfile.mkstemp()
     file_store = tempfile.mkdtemp()
 
@@ -23,6 +23,9 @@ def app():
             "TESTING": True,
             "DATABASE": db_path,
             "FILE_STORE": file_store,
+            # Keep runs from writing into the source tree's instance folder.
+            "ACCESS_LOG": str(tmp_path / "access.log"),
+            "METRICS_DIR": str(tmp_path / "metrics"),
         }
     )
 
@@ -44,6 +47,9 @@ def app():
 
     os.close(db_fd)
     os.unlink(db_path)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
     shutil.rmtree(file_store)
 
 
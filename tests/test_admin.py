@@ -52,7 +52,7 @@ def test_admin_prevent_self_deletion(client, auth, app):
     assert b"Security alert: You cannot delete your own account." in response.data
 
 def test_delete_user_cleans_up_files(
-    client: FlaskClient, auth: AuthActions, app: Flask
+    client: FlaskClient, auth: AuthActions, app: Flask, runner
 ):
     auth.login(username="test user", password="password")
 
@@ -78,7 +78,10 @@ def test_delete_user_cleans_up_files(
     response = client.post(f"/admin/delete_user/{user_id}", follow_redirects=True)
     assert response.status_code == 200
     assert b"User account removed" in response.data
+    assert b"Clean up files of test user" in response.data
 
+    result = runner.invoke(args=["run-worker", "--once"])
+    assert "Processed 1 job(s)." in result.output
     assert not os.path.exists(file_path), "File should be deleted from disk"
 
     with app.app_context():
@@ -88,4 +91,48 @@ def test_delete_user_cleans_up_files(
         file_record_after = query_db(
             "SELECT * FROM files WHERE id = ?", (file_record["id"],), single=True
         )
-        assert file_record_after is None
\ No newline at end of file
+        assert file_record_after is None
+
+
+def test_admin_bulk_create_users(client, auth, app):
+    app.config["PASSWORD_HASH_WORKERS"] = 2
+    auth.login(username="default admin", password="password")
+
+    response = client.post(
+        "/admin/users/bulk",
+        json=[
+            {"username": "bulk1", "password": "secret1"},
+            {"username": "bulk2", "password": "secret2", "is_admin": True},
+            {"username": "test user", "password": "taken"},
+            {"username": "bulk3"},
+        ],
+    )
+    body = response.get_json()
+    assert response.status_code == 200
+    assert (body["created"], body["failed"]) == (2, 2)
+    assert [result.get("error") for result in body["results"]] == [
+        None,
+        None,
+        "Username already exists.",
+        "Password is required.",
+    ]
+
+    csv_body = "username,password,is_admin\nbulk4,secret4,no\nbulk1,again,no\n"
+    response = client.post("/admin/users/bulk", data=csv_body, content_type="text/csv")
+    assert response.get_json()["created"] == 1
+
+    auth.logout()
+    assert auth.login(username="bulk2", password="secret2").status_code == 302
+    with app.app_context():
+        assert query_db("SELECT is_admin FROM users WHERE username = 'bulk2'", single=True)[0] == 1
+
+
+def test_create_users_command(runner, app, tmp_path):
+    source = tmp_path / "users.json"
+    source.write_text('{"users": [{"username": "cli1", "password": "pw"}, {"username": ""}]}')
+
+    result = runner.invoke(args=["create-users", str(source)])
+    assert "Created 1 user(s), 1 failed." in result.output
+
+    with app.app_context():
+        assert query_db("SELECT id FROM users WHERE username = 'cli1'", single=True) is not None
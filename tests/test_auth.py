@@ -1,3 +1,9 @@
+import time
+
+import jwt
+
+from app.auth import RevocationList, TokenCache, revoke_access_token
+from app.passwords import HashPoolBusy, get_hash_pool
 from tests.conftest import AuthActions
 from flask import url_for
 from app.db import query_db
@@ -75,3 +81,168 @@ def test_logout(client: FlaskClient, auth: AuthActions):
     assert response.status_code == 200
     assert response.request.path == url_for("auth.login").rstrip("/")
     assert client.get_cookie("access_token") is None
+
+
+def test_token_verified_once_across_requests(client: FlaskClient, auth: AuthActions, monkeypatch):
+    auth.login()
+    calls = []
+    real_decode = jwt.decode
+    monkeypatch.setattr(jwt, "decode", lambda *a, **kw: calls.append(1) or real_decode(*a, **kw))
+
+    assert client.get("/dashboard/").status_code == 200
+    assert client.get("/dashboard/").status_code == 200
+    assert len(calls) == 1
+
+
+def test_token_cache_evicts_expired_and_lru():
+    cache = TokenCache(max_size=2)
+    cache.put("expired", {"exp": time.time() - 1})
+    assert cache.get("expired") is None
+
+    cache.put("a", {"exp": time.time() + 60})
+    cache.put("b", {"exp": time.time() + 60})
+    cache.get("a")
+    cache.put("c", {"exp": time.time() + 60})
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+
+def test_login_sheds_load_when_hash_pool_is_busy(client, app):
+    app.config["PASSWORD_HASH_CONCURRENCY"] = 1
+    app.config["PASSWORD_HASH_TIMEOUT"] = 0.01
+
+    with app.app_context():
+        pool = get_hash_pool()
+        assert pool.verify(pool.hash("secret"), "secret")
+
+        pool._slots.acquire()
+        try:
+            response = client.post("/login", data={"username": "test user", "password": "password"})
+        finally:
+            pool._slots.release()
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert b"The server is busy" in response.data
+
+    response = client.post("/login", data={"username": "test user", "password": "password"})
+    assert response.status_code == 302
+
+
+def test_hash_many_shares_the_slot_limit(app):
+    app.config["PASSWORD_HASH_WORKERS"] = 2
+    app.config["PASSWORD_HASH_CONCURRENCY"] = 1
+
+    with app.app_context():
+        pool = get_hash_pool()
+        hashes = pool.hash_many(["a", "b", "c"])
+        assert [pool.verify(h, p) for h, p in zip(hashes, "abc")] == [True] * 3
+
+        pool.timeout = 0.01
+        pool._slots.acquire()
+        try:
+            with pytest.raises(HashPoolBusy):
+                pool.hash_many(["a", "b"])
+        finally:
+            pool._slots.release()
+        assert pool.hash_many(["d"])
+        pool.close()
+
+
+def test_hash_pool_splits_cpus_between_web_workers(app, monkeypatch):
+    monkeypatch.setattr("os.cpu_count", lambda: 8)
+    app.config["WEB_WORKERS"] = 4
+    with app.app_context():
+        assert get_hash_pool().workers == 2
+
+    app.extensions.pop("password_pool")
+    app.config["WEB_WORKERS"] = 16
+    with app.app_context():
+        assert get_hash_pool().workers == 1
+
+
+def test_refresh_token_renews_expired_access_token(client: FlaskClient, auth: AuthActions, app, capsys):
+    app.config["ACCESS_TOKEN_LIFETIME"] = -1
+    auth.login()
+    expired = client.get_cookie("access_token").value
+    app.config["ACCESS_TOKEN_LIFETIME"] = 900
+
+    response = client.get("/dashboard/")
+    assert response.status_code == 200
+    assert capsys.readouterr().out == ""
+    renewed = client.get_cookie("access_token").value
+    assert renewed != expired
+
+    with app.app_context():
+        (stored,) = query_db("SELECT * FROM refresh_tokens")
+        assert stored["expires_at"] > time.time()
+
+    client.get("/logout")
+    with app.app_context():
+        assert query_db("SELECT * FROM refresh_tokens") == []
+
+    # A revoked refresh token no longer renews anything.
+    client.set_cookie("access_token", expired)
+    client.set_cookie("refresh_token", "revoked")
+    response = client.get("/dashboard/")
+    assert response.status_code == 302
+
+
+def test_logout_revokes_access_token(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    token = client.get_cookie("access_token").value
+    client.get("/logout")
+
+    # Replaying the access token after logout is refused before its exp.
+    client.set_cookie("access_token", token)
+    response = client.get("/dashboard/")
+    assert response.status_code == 302
+
+
+def test_revocations_sync_incrementally_and_expire(app):
+    with app.app_context():
+        other_worker = RevocationList(sync_interval=0)
+        assert not other_worker.is_revoked("a")
+
+        now = time.time()
+        revoke_access_token({"jti": "a", "exp": now + 60})
+        revoke_access_token({"jti": "b", "exp": now - 1})
+        assert other_worker.is_revoked("a")
+        assert not other_worker.is_revoked("b")
+
+        # Expired rows are compacted by the next revocation.
+        revoke_access_token({"jti": "c", "exp": now + 60})
+        rows = query_db("SELECT jti FROM revoked_tokens ORDER BY id")
+        assert [row["jti"] for row in rows] == ["a", "c"]
+
+
+def test_login_attempts_are_rate_limited(client: FlaskClient, app, monkeypatch):
+    app.config["RATE_LIMIT_LOGIN_USERNAME"] = (3, 300.0)
+    for _ in range(3):
+        response = client.post("/login", data={"username": "test user", "password": "wrong"})
+        assert response.status_code == 302
+
+    # Over budget: rejected before the password is even looked at.
+    monkeypatch.setattr("app.auth.verify_password", lambda *args: pytest.fail("hashed"))
+    response = client.post("/login", data={"username": "Test User", "password": "password"})
+    assert response.status_code == 429
+    assert 190 <= int(response.headers["Retry-After"]) <= 200
+    assert b"Too many login attempts" in response.data
+
+    # Other usernames still have their own budget.
+    monkeypatch.undo()
+    response = client.post("/login", data={"username": "test user 2", "password": "password"})
+    assert response.status_code == 302
+
+
+def test_login_ip_budget_is_checked_before_the_form(client: FlaskClient, app, monkeypatch):
+    app.config["RATE_LIMIT_LOGIN_IP"] = (1, 300.0)
+    client.post("/login", data={"username": "test user", "password": "wrong"})
+
+    monkeypatch.setattr(
+        "flask.Request.form", property(lambda self: pytest.fail("form parsed"))
+    )
+    response = client.post("/login", data={"username": "test user", "password": "password"})
+    assert response.status_code == 429
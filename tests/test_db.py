@@ -0,0 +1,286 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from app import create_app
+from app.db import (
+    ConnectionPool,
+    PoolTimeout,
+    WriteQueue,
+    batch_db,
+    get_db,
+    get_pool,
+    get_write_queue,
+    iter_db,
+    query_db,
+    transaction,
+    write_db,
+)
+
+
+def test_connection_reused_across_requests(app: Flask):
+    with app.app_context():
+        first = get_db()
+    with app.app_context():
+        assert get_db() is first
+        stats = get_pool().stats()
+
+    assert stats["misses"] == 1
+    assert stats["checkouts"] >= 2
+
+
+def test_pool_is_bounded(app: Flask):
+    pool = ConnectionPool(app.config["DATABASE"], size=1, timeout=0.05)
+    db = pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(db)
+    assert pool.acquire() is db
+    assert pool.stats()["waits"] == 1
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_broken_connection_is_replaced(app: Flask):
+    with app.app_context():
+        broken = get_db()
+        broken.close()
+
+    with app.app_context():
+        assert get_db() is not broken
+        assert query_db("SELECT 1 AS one", single=True)["one"] == 1
+        assert get_pool().stats()["invalidated"] == 1
+
+
+def test_pool_created_once_across_threads(app: Flask, monkeypatch):
+    app.extensions.pop("db_pool", None)
+    created = []
+    init = ConnectionPool.__init__
+
+    def slow_init(self, *args, **kwargs):
+        time.sleep(0.05)
+        init(self, *args, **kwargs)
+        created.append(self)
+
+    monkeypatch.setattr(ConnectionPool, "__init__", slow_init)
+    pools = []
+
+    def worker():
+        with app.app_context():
+            pools.append(get_pool())
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert all(pool is created[0] for pool in pools)
+
+
+def test_connection_returns_to_its_own_pool(app: Flask):
+    with app.app_context():
+        first = get_pool()
+        db = get_db()
+        app.extensions.pop("db_pool")
+        second = get_pool()
+
+    assert second is not first
+    with app.app_context():
+        assert first.acquire() is db
+
+
+def test_connections_use_wal(app: Flask):
+    with app.app_context():
+        assert query_db("PRAGMA journal_mode", single=True)[0] == "wal"
+        assert query_db("PRAGMA busy_timeout", single=True)[0] == 5000
+
+
+def test_write_queue_group_commits(app: Flask):
+    app.config["DATABASE_WRITE_QUEUE"] = True
+    with app.app_context():
+        before = get_write_queue().stats()
+
+    def insert(i: int):
+        with app.app_context():
+            write_db(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                (f"queued {i}", "hash"),
+            )
+
+    threads = [threading.Thread(target=insert, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        rows = query_db("SELECT * FROM users WHERE username LIKE 'queued %'")
+        stats = get_write_queue().stats()
+        get_write_queue().close()
+
+    assert len(rows) == 20
+    assert stats["statements"] - before["statements"] == 20
+    assert 1 <= stats["commits"] - before["commits"] <= 20
+
+
+def test_write_queue_survives_unbindable_values(app: Flask):
+    app.config["DATABASE_WRITE_QUEUE"] = True
+
+    with app.app_context():
+        with pytest.raises(OverflowError):
+            write_db("INSERT INTO users (username, password_hash) VALUES (?, ?)", ("big", 2**64))
+        with pytest.raises((TypeError, sqlite3.ProgrammingError)):
+            write_db("INSERT INTO users (username, password_hash) VALUES (?, ?)", ("list", [1]))
+
+        row = write_db(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id",
+            ("after bad args", "hash"),
+            single=True,
+        )
+        get_write_queue().close()
+
+    assert row is not None
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_write_queue_restarts_after_writer_dies(app: Flask, monkeypatch):
+    app.config["DATABASE_WRITE_QUEUE"] = True
+    commit = WriteQueue._commit
+
+    def crash_once(self, db, batch):
+        monkeypatch.setattr(WriteQueue, "_commit", commit)
+        raise RuntimeError("writer died")
+
+    monkeypatch.setattr(WriteQueue, "_commit", crash_once)
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            write_db("INSERT INTO users (username, password_hash) VALUES (?, ?)", ("lost", "hash"))
+        row = write_db(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id",
+            ("after restart", "hash"),
+            single=True,
+        )
+        get_write_queue().close()
+
+    assert row is not None
+
+
+def test_write_queue_isolates_failures(app: Flask):
+    app.config["DATABASE_WRITE_QUEUE"] = True
+
+    with app.app_context():
+        with pytest.raises(sqlite3.IntegrityError):
+            write_db(
+                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                ("test user", "hash"),
+            )
+        row = write_db(
+            "INSERT INTO users (username, password_hash) VALUES (?, ?) RETURNING id",
+            ("after failure", "hash"),
+            single=True,
+        )
+        get_write_queue().close()
+
+        assert row is not None
+        assert query_db(
+            "SELECT 1 FROM users WHERE id = ?", (row["id"],), single=True
+        )
+
+
+def test_reads_do_not_open_transactions(app: Flask):
+    with app.app_context():
+        query_db("SELECT * FROM users")
+        assert not get_db().in_transaction
+
+
+def test_transaction_rolls_back_on_error(app: Flask):
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            with transaction():
+                write_db("DELETE FROM users WHERE username = ?", ("test user",))
+                raise RuntimeError("abort")
+
+        assert query_db(
+            "SELECT 1 FROM users WHERE username = ?", ("test user",), single=True
+        )
+
+
+def test_lazy_iteration_modes(app: Flask):
+    with app.app_context():
+        for i in range(5):
+            write_db("INSERT INTO users (username, password_hash) VALUES (?, 'x')", (f"lazy{i}",))
+
+        query = "SELECT username FROM users WHERE username LIKE 'lazy%' ORDER BY username"
+        assert [row["username"] for row in iter_db(query)] == [f"lazy{i}" for i in range(5)]
+        assert [len(rows) for rows in batch_db(query, size=2)] == [2, 2, 1]
+
+        abandoned = iter_db(query)
+        next(abandoned)
+
+    # The request's open cursors are closed before the connection is pooled.
+    with pytest.raises(sqlite3.ProgrammingError):
+        next(abandoned)
+
+
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    is_admin INTEGER DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+    display_name TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    file_path TEXT NOT NULL,
+    uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_files_user_id ON files(user_id);
+INSERT INTO users (username, password_hash) VALUES ('old user', 'hash'), ('empty user', 'hash');
+INSERT INTO files (user_id, display_name, size_bytes, file_path) VALUES (1, 'a.txt', 10, 'x_a.txt'), (1, 'b.txt', 5, 'x_b.txt');
+"""
+
+
+def test_migrate_db_upgrades_a_baseline_database(tmp_path):
+    db_path = str(tmp_path / "old.sqlite")
+    with sqlite3.connect(db_path) as db:
+        db.executescript(BASELINE_SCHEMA)
+    app = create_app(
+        {
+            "TESTING": True,
+            "DATABASE": db_path,
+            "FILE_STORE": str(tmp_path / "files"),
+            "ACCESS_LOG": str(tmp_path / "access.log"),
+            "METRICS_DIR": str(tmp_path / "metrics"),
+        }
+    )
+    (tmp_path / "files" / "x_a.txt").write_bytes(b"0123456789")
+    runner = app.test_cli_runner()
+
+    with app.app_context():
+        for _ in range(2):
+            assert "Migrated the database." in runner.invoke(args=["migrate-db"]).output
+        assert "Initialized the database." in runner.invoke(args=["init-db"]).output
+        assert "Moved 1 file(s)." in runner.invoke(args=["rebalance-store"]).output
+
+        usage = {
+            row["user_id"]: (row["file_count"], row["bytes_used"])
+            for row in query_db("SELECT * FROM user_usage")
+        }
+        assert usage == {1: (2, 15), 2: (0, 0)}
+        # The flat file was moved into the store; the missing one is left.
+        checksums = [row["checksum"] for row in query_db("SELECT checksum FROM files ORDER BY id")]
+        assert checksums == [hashlib.sha256(b"0123456789").hexdigest(), None]
+        # Existing users are kept, and no default admin is added to them.
+        assert query_db("SELECT COUNT(*) AS n FROM users", single=True)["n"] == 2
+        assert query_db("SELECT * FROM rate_limits") == []
@@ -1,10 +1,21 @@
+import base64
+import gzip
+import hashlib
 import io
 import os
+import re
+import tarfile
+import zipfile
+from datetime import timedelta
 
+import pytest
 from flask import url_for
 from flask.testing import FlaskClient
+from werkzeug.http import http_date, parse_date
 
-from app.db import query_db
+from app import downloads
+from app.db import query_db, transaction, write_db
+from app.storage import _relocate, open_stored, release_file
 from tests.conftest import AuthActions
 
 
@@ -141,3 +152,512 @@ def test_access_other_user_file(client: FlaskClient, auth: AuthActions, app):
     # Try to delete first user's file
     response = client.post(f"/dashboard/delete/{file_id}", follow_redirects=True)
     assert b"File not found" in response.data
+
+
+def test_upload_streams_in_chunks(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_CHUNK_SIZE"] = 64
+    content = os.urandom(10_000)
+    auth.login()
+
+    client.post(
+        "/dashboard/upload",
+        data={"note": "ignored", "file": (io.BytesIO(content), "chunked.bin")},
+        content_type="multipart/form-data",
+    )
+
+    with app.app_context():
+        file_record = query_db(
+            "SELECT * FROM files WHERE display_name = 'chunked.bin'", single=True
+        )
+        assert file_record["size_bytes"] == len(content)
+        assert file_record["checksum"] == hashlib.sha256(content).hexdigest()
+
+        with open(os.path.join(app.config["FILE_STORE"], file_record["file_path"]), "rb") as f:
+            assert f.read() == content
+
+
+def test_upload_too_large(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_MAX_SIZE"] = 100
+    auth.login()
+
+    response = client.post(
+        "/dashboard/upload",
+        data={"file": (io.BytesIO(b"x" * 101), "big.txt")},
+        content_type="multipart/form-data",
+        follow_redirects=True,
+    )
+    assert b"File exceeds the maximum upload size" in response.data
+
+    with app.app_context():
+        assert query_db("SELECT * FROM files") == []
+    assert [name for _, _, names in os.walk(app.config["FILE_STORE"]) for name in names] == []
+
+
+def _upload(client: FlaskClient, app, content: bytes, name: str):
+    client.post(
+        "/dashboard/upload",
+        data={"file": (io.BytesIO(content), name)},
+        content_type="multipart/form-data",
+    )
+    with app.app_context():
+        return query_db("SELECT * FROM files WHERE display_name = ?", (name,), single=True)
+
+
+def test_download_conditional(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    file_record = _upload(client, app, b"conditional content", "conditional.txt")
+    url = f"/dashboard/download/{file_record['id']}"
+
+    response = client.get(url)
+    assert response.headers["ETag"] == f'"{file_record["checksum"]}"'
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+    response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_download_ranges(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    file_record = _upload(client, app, b"0123456789", "ranges.txt")
+    url = f"/dashboard/download/{file_record['id']}"
+    etag = f'"{file_record["checksum"]}"'
+
+    response = client.get(url, headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    assert response.data == b"2345"
+
+    response = client.get(url, headers={"Range": "bytes=-3", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.data == b"789"
+
+    response = client.get(url, headers={"Range": "bytes=0-1,8-"})
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert b"Content-Range: bytes 0-1/10\r\n\r\n01\r\n" in response.data
+    assert b"Content-Range: bytes 8-9/10\r\n\r\n89\r\n" in response.data
+
+    response = client.get(url, headers={"Range": "bytes=0-1", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.data == b"0123456789"
+
+    response = client.get(url, headers={"Range": "bytes=20-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+
+
+def test_download_closes_stored_file(client: FlaskClient, auth: AuthActions, app, monkeypatch):
+    auth.login()
+    file_record = _upload(client, app, b"0123456789", "closed.txt")
+    url = f"/dashboard/download/{file_record['id']}"
+    opened = []
+
+    def tracking_open(*args):
+        f = open_stored(*args)
+        opened.append(f)
+        return f
+
+    monkeypatch.setattr(downloads, "open_stored", tracking_open)
+    for headers in ({}, {"Range": "bytes=2-5"}, {"Range": "bytes=0-1,8-"}):
+        response = client.get(url, headers=headers)
+        assert response.data
+        response.close()
+    assert len(opened) == 3
+    assert all(f.closed for f in opened)
+
+
+def test_if_range_date_must_match_exactly(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    file_record = _upload(client, app, b"0123456789", "dated.txt")
+    url = f"/dashboard/download/{file_record['id']}"
+    last_modified = client.get(url).headers["Last-Modified"]
+
+    response = client.get(url, headers={"Range": "bytes=2-5", "If-Range": last_modified})
+    assert response.status_code == 206
+
+    later = http_date(parse_date(last_modified) + timedelta(seconds=1))
+    response = client.get(url, headers={"Range": "bytes=2-5", "If-Range": later})
+    assert response.status_code == 200
+
+
+def test_identical_uploads_share_storage(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    first = _upload(client, app, b"shared content", "first.txt")
+    auth.login(username="test user 2")
+    second = _upload(client, app, b"shared content", "second.txt")
+
+    assert first["file_path"] == second["file_path"]
+    full_path = os.path.join(app.config["FILE_STORE"], first["file_path"])
+
+    with app.app_context():
+        blob = query_db("SELECT * FROM blobs WHERE path = ?", (first["file_path"],), single=True)
+        assert blob["refcount"] == 2
+
+    client.post(f"/dashboard/delete/{second['id']}")
+    assert os.path.exists(full_path)
+
+    auth.login()
+    client.post(f"/dashboard/delete/{first['id']}")
+    assert not os.path.exists(full_path)
+
+    with app.app_context():
+        assert query_db("SELECT * FROM blobs") == []
+
+
+def test_released_content_survives_rollback(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    client.post("/dashboard/upload", data={"file": (io.BytesIO(b"keep me"), "keep.txt")})
+
+    with app.app_context():
+        file = query_db("SELECT * FROM files", single=True)
+        with pytest.raises(RuntimeError):
+            with transaction(immediate=True):
+                write_db("DELETE FROM files WHERE id = ?", (file["id"],))
+                release_file(file["file_path"])
+                raise RuntimeError("later step failed")
+
+    assert client.get(f"/dashboard/download/{file['id']}").data == b"keep me"
+    assert os.listdir(os.path.dirname(os.path.join(app.config["FILE_STORE"], file["file_path"]))) == [
+        os.path.basename(file["file_path"])
+    ]
+
+
+def test_rebalance_store(client: FlaskClient, auth: AuthActions, app, runner):
+    content = b"legacy content"
+    with open(os.path.join(app.config["FILE_STORE"], "abc_legacy.txt"), "wb") as f:
+        f.write(content)
+
+    with app.app_context():
+        user = query_db("SELECT id FROM users WHERE username = 'test user'", single=True)
+        query_db(
+            "INSERT INTO files (user_id, display_name, file_path, size_bytes) VALUES (?, ?, ?, ?)",
+            (user["id"], "legacy.txt", "abc_legacy.txt", len(content)),
+        )
+
+    result = runner.invoke(args=["rebalance-store"])
+    assert "Moved 1 file(s)." in result.output
+
+    digest = hashlib.sha256(content).hexdigest()
+    with app.app_context():
+        file_record = query_db("SELECT * FROM files WHERE display_name = 'legacy.txt'", single=True)
+        assert file_record["file_path"] == os.path.join(digest[:2], digest[2:4], digest)
+        assert file_record["checksum"] == digest
+        assert query_db("SELECT refcount FROM blobs", single=True)["refcount"] == 1
+    assert not os.path.exists(os.path.join(app.config["FILE_STORE"], "abc_legacy.txt"))
+
+    app.config["FILE_STORE_SHARD_DEPTH"] = 1
+    runner.invoke(args=["rebalance-store"])
+
+    auth.login()
+    response = client.get(f"/dashboard/download/{file_record['id']}")
+    assert response.data == content
+
+    with app.app_context():
+        file_record = query_db("SELECT * FROM files WHERE display_name = 'legacy.txt'", single=True)
+        assert file_record["file_path"] == os.path.join(digest[:2], digest)
+        assert query_db("SELECT refcount FROM blobs", single=True)["refcount"] == 1
+
+
+def test_rebalance_store_shares_existing_blob(client: FlaskClient, auth: AuthActions, app, runner):
+    content = b"shared content"
+    auth.login()
+    client.post("/dashboard/upload", data={"file": (io.BytesIO(content), "uploaded.txt")})
+    with open(os.path.join(app.config["FILE_STORE"], "abc_legacy.txt"), "wb") as f:
+        f.write(content)
+
+    with app.app_context():
+        user = query_db("SELECT id FROM users WHERE username = 'test user'", single=True)
+        query_db(
+            "INSERT INTO files (user_id, display_name, file_path, size_bytes) VALUES (?, ?, ?, ?)",
+            (user["id"], "legacy.txt", "abc_legacy.txt", len(content)),
+        )
+
+    # The existing blob is misplaced too, so the legacy file's target path
+    # differs from where its content is already stored.
+    app.config["FILE_STORE_SHARD_DEPTH"] = 1
+    runner.invoke(args=["rebalance-store"])
+
+    digest = hashlib.sha256(content).hexdigest()
+    with app.app_context():
+        paths = {row["file_path"] for row in query_db("SELECT file_path FROM files")}
+        (blob,) = query_db("SELECT * FROM blobs")
+    assert paths == {blob["path"]} == {os.path.join(digest[:2], digest)}
+    assert blob["refcount"] == 2
+    assert not os.path.exists(os.path.join(app.config["FILE_STORE"], digest[:2], digest[2:4], digest))
+    assert not os.path.exists(os.path.join(app.config["FILE_STORE"], "abc_legacy.txt"))
+
+
+def test_rebalance_skips_files_deleted_meanwhile(app):
+    with app.app_context():
+        assert _relocate([("gone.txt", "aa/gone", "aa" * 32, 1)]) == 0
+        assert query_db("SELECT * FROM blobs") == []
+
+
+def test_dashboard_keyset_pagination(client: FlaskClient, auth: AuthActions, app):
+    with app.app_context():
+        user = query_db("SELECT id FROM users WHERE username = 'test user'", single=True)
+        for i, size in enumerate([30, 10, 50, 10, 40]):
+            query_db(
+                "INSERT INTO files (user_id, display_name, file_path, size_bytes) VALUES (?, ?, ?, ?)",
+                (user["id"], f"page{i}.txt", f"page{i}.txt", size),
+            )
+
+    auth.login()
+    seen = []
+    url = "/dashboard/?sort=size&order=asc&limit=2"
+    while url:
+        page = client.get(url).get_data(as_text=True)
+        seen += re.findall(r"<td>(page\d\.txt)</td>", page)
+        match = re.search(r'href="([^"]*cursor=[^"]*)">Next page', page)
+        url = match.group(1).replace("&amp;", "&") if match else None
+
+    assert seen == ["page1.txt", "page3.txt", "page0.txt", "page4.txt", "page2.txt"]
+
+
+@pytest.mark.parametrize(
+    "cursor",
+    [
+        "not-a-cursor",
+        base64.urlsafe_b64encode(b"[[1], 1]").decode(),
+        base64.urlsafe_b64encode(b'[{"a": 1}, 1]').decode(),
+        base64.urlsafe_b64encode(b'["a", 18446744073709551616]').decode(),
+        base64.urlsafe_b64encode(b"[18446744073709551616, 1]").decode(),
+    ],
+)
+def test_dashboard_rejects_bad_cursor(client: FlaskClient, auth: AuthActions, cursor: str):
+    auth.login()
+    assert client.get(f"/dashboard/?cursor={cursor}").status_code == 400
+
+
+def test_dashboard_is_streamed(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    _upload(client, app, b"streamed", "streamed.txt")
+
+    response = client.get("/dashboard/")
+    assert response.is_streamed
+    page = response.get_data(as_text=True)
+    assert "streamed.txt" in page
+    assert "File uploaded successfully" in page
+
+    # The flashed message was consumed before streaming began.
+    assert "File uploaded successfully" not in client.get("/dashboard/").get_data(as_text=True)
+
+
+def test_usage_tracks_uploads_and_quota(client: FlaskClient, auth: AuthActions, app):
+    app.config["USER_QUOTA_BYTES"] = 10
+    auth.login()
+
+    def usage():
+        with app.app_context():
+            row = query_db(
+                "SELECT file_count, bytes_used FROM user_usage JOIN users ON users.id = user_id WHERE username = 'test user'",
+                single=True,
+            )
+            return tuple(row)
+
+    first = _upload(client, app, b"123456", "first.txt")
+    assert usage() == (1, 6)
+    assert _upload(client, app, b"7890123", "second.txt") is None
+    assert "remaining storage quota of 4.00 B" in client.get("/dashboard/").get_data(as_text=True)
+    assert usage() == (1, 6)
+
+    client.post(f"/dashboard/delete/{first['id']}")
+    assert usage() == (0, 0)
+    assert _upload(client, app, b"7890123", "second.txt") is not None
+    assert usage() == (1, 7)
+
+
+def test_batch_upload(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_MAX_SIZE"] = 10
+    auth.login()
+
+    response = client.post(
+        "/dashboard/upload",
+        data={
+            "file": [
+                (io.BytesIO(b"first"), "one.txt"),
+                (io.BytesIO(b"second"), "two.txt"),
+                (io.BytesIO(b"far too large"), "big.txt"),
+            ]
+        },
+        content_type="multipart/form-data",
+        headers={"Accept": "application/json"},
+    )
+    body = response.get_json()
+    assert (body["uploaded"], body["failed"]) == (2, 1)
+    assert [result["name"] for result in body["results"]] == ["one.txt", "two.txt", "big.txt"]
+    assert body["results"][2]["error"].startswith("File exceeds the maximum upload size")
+
+    with app.app_context():
+        names = [row["display_name"] for row in query_db("SELECT display_name FROM files ORDER BY id")]
+    assert names == ["one.txt", "two.txt"]
+
+
+def test_batch_upload_extracts_archives(client: FlaskClient, auth: AuthActions, app):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("docs/a.txt", b"alpha")
+        zf.writestr("docs/b.txt", b"beta")
+        zf.writestr("docs/empty/", b"")
+    archive.seek(0)
+
+    auth.login()
+    response = client.post(
+        "/dashboard/upload",
+        data={
+            "extract": "on",
+            "file": [(archive, "docs.zip"), (io.BytesIO(b"not a zip"), "broken.zip")],
+        },
+        content_type="multipart/form-data",
+        follow_redirects=True,
+    )
+    page = response.get_data(as_text=True)
+    assert "Uploaded 2 of 3 files" in page
+    assert "broken.zip: Could not read archive" in page
+
+    with app.app_context():
+        rows = query_db("SELECT display_name, checksum FROM files ORDER BY id")
+    assert [(row["display_name"], row["checksum"]) for row in rows] == [
+        ("docs/a.txt", hashlib.sha256(b"alpha").hexdigest()),
+        ("docs/b.txt", hashlib.sha256(b"beta").hexdigest()),
+    ]
+    assert os.listdir(os.path.join(app.config["FILE_STORE"], ".tmp")) == []
+
+
+def test_archive_extraction_is_capped(client: FlaskClient, auth: AuthActions, app):
+    def upload(archive: io.BytesIO, name: str) -> str:
+        archive.seek(0)
+        response = client.post(
+            "/dashboard/upload",
+            data={"extract": "on", "file": (archive, name)},
+            content_type="multipart/form-data",
+            headers={"Accept": "application/json"},
+        )
+        (result,) = [result for result in response.json["results"] if result["name"] == name]
+        return result["error"]
+
+    auth.login()
+    bomb = io.BytesIO()
+    with zipfile.ZipFile(bomb, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("zeros.bin", bytes(4 * 1024 * 1024))
+    assert upload(bomb, "bomb.zip") == "Archive is compressed too densely to unpack safely."
+
+    app.config["UPLOAD_MAX_ARCHIVE_BYTES"] = 10
+    many = io.BytesIO()
+    with zipfile.ZipFile(many, "w") as zf:
+        zf.writestr("a.txt", b"12345678")
+        zf.writestr("b.txt", b"12345678")
+    assert upload(many, "many.zip") == "Archive expands to more than 10.00 B."
+
+    assert os.listdir(os.path.join(app.config["FILE_STORE"], ".tmp")) == []
+
+
+def test_download_archive(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    text = _upload(client, app, b"hello " * 1000, "notes.txt")
+    image = _upload(client, app, b"\x89PNG fake image", "photo.png")
+    _upload(client, app, b"same name", "notes.txt")
+
+    response = client.get("/dashboard/download/archive?all=1")
+    assert response.is_streamed
+    assert response.mimetype == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ["notes.txt", "photo.png", "notes (1).txt"]
+        assert archive.read("notes.txt") == b"hello " * 1000
+        assert archive.getinfo("notes.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert archive.getinfo("photo.png").compress_type == zipfile.ZIP_STORED
+
+    response = client.post(
+        "/dashboard/download/archive", data={"id": [str(text["id"]), str(image["id"])]}
+    )
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == ["notes.txt", "photo.png"]
+
+    auth.logout()
+    auth.login(username="test user 2")
+    response = client.get(f"/dashboard/download/archive?id={text['id']}")
+    assert response.status_code == 302
+
+
+def test_archive_names_cannot_escape(client: FlaskClient, auth: AuthActions, app):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("../../unpacked.txt", b"unpacked")
+        zf.writestr("./..", b"nameless")
+    archive.seek(0)
+
+    auth.login()
+    client.post(
+        "/dashboard/upload",
+        data={"extract": "on", "file": (archive, "slip.zip")},
+        content_type="multipart/form-data",
+    )
+    _upload(client, app, b"evil", "../../evil.txt")
+    with app.app_context():
+        # A name stored before uploads were sanitized.
+        query_db("UPDATE files SET display_name = '../..' WHERE display_name = 'file-2'")
+        names = [row["display_name"] for row in query_db("SELECT display_name FROM files ORDER BY id")]
+    assert names == ["unpacked.txt", "../..", "evil.txt"]
+
+    response = client.get("/dashboard/download/archive?all=1")
+    with zipfile.ZipFile(io.BytesIO(response.data)) as downloaded:
+        assert downloaded.namelist() == ["unpacked.txt", "file-2", "evil.txt"]
+
+
+def test_compression_at_rest(client: FlaskClient, auth: AuthActions, app):
+    app.config["FILE_STORE_COMPRESSION"] = "gzip"
+    content = b"timestamp,level,message\n" + b"2025-01-01,INFO,all good\n" * 5000
+    noise = os.urandom(100_000)
+
+    auth.login()
+    text = _upload(client, app, content, "log.csv")
+    random = _upload(client, app, noise, "noise.bin")
+
+    with app.app_context():
+        blobs = {
+            row["digest"]: row
+            for row in query_db("SELECT digest, codec, size_bytes, stored_size FROM blobs")
+        }
+    assert text["size_bytes"] == len(content)
+    assert blobs[text["checksum"]]["codec"] == "gzip"
+    assert blobs[text["checksum"]]["stored_size"] < len(content) // 10
+    assert blobs[random["checksum"]]["codec"] is None
+
+    url = f"/dashboard/download/{text['id']}"
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"] == f'"{text["checksum"]}-gzip"'
+    assert gzip.decompress(response.data) == content
+
+    response = client.get(url)
+    assert "Content-Encoding" not in response.headers
+    assert response.content_length == len(content)
+    assert response.data == content
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip", "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.data == content[100:200]
+
+    response = client.get(f"/dashboard/download/archive?id={text['id']}")
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.read("log.csv") == content
+
+
+def test_archives_are_compressed_unless_extracted(client: FlaskClient, auth: AuthActions, app):
+    app.config["FILE_STORE_COMPRESSION"] = "gzip"
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        content = b"line of text\n" * 10000
+        info = tarfile.TarInfo("text.txt")
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    data = archive.getvalue()
+
+    auth.login()
+    stored = _upload(client, app, data, "bundle.tar")
+    with app.app_context():
+        blob = query_db("SELECT codec FROM blobs WHERE digest = ?", (stored["checksum"],), single=True)
+    assert blob["codec"] == "gzip"
+    assert client.get(f"/dashboard/download/{stored['id']}").data == data
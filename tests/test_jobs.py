@@ -0,0 +1,53 @@
+import os
+
+from flask import Flask
+
+from app.db import query_db, write_db
+from app.jobs import HANDLERS, claim_job, enqueue, job, work
+
+
+def test_reclaim_files_in_batches(app: Flask):
+    app.config["JOBS_BATCH_SIZE"] = 2
+
+    with app.app_context():
+        paths = [f"legacy_{i}.txt" for i in range(3)]
+        for path in paths:
+            with open(os.path.join(app.config["FILE_STORE"], path), "w") as f:
+                f.write(path)
+
+        job_id = enqueue("reclaim_files", "Clean up files of test user")
+        for path in [*paths, "already_missing.txt"]:
+            write_db("INSERT INTO job_paths (job_id, path) VALUES (?, ?)", (job_id, path))
+
+        assert work(once=True) == 1
+        finished = query_db("SELECT * FROM jobs WHERE id = ?", (job_id,), single=True)
+
+    assert (finished["status"], finished["done"], finished["attempts"]) == ("done", 4, 1)
+    assert not any(os.path.exists(os.path.join(app.config["FILE_STORE"], p)) for p in paths)
+
+
+def test_failed_job_is_retried_with_backoff(app: Flask):
+    app.config["JOBS_MAX_ATTEMPTS"] = 2
+    calls = []
+
+    @job("flaky")
+    def flaky(job):
+        calls.append(job["attempts"])
+        raise OSError("disk unavailable")
+
+    try:
+        with app.app_context():
+            job_id = enqueue("flaky", "Flaky job")
+            work(once=True)
+            retry = query_db("SELECT * FROM jobs WHERE id = ?", (job_id,), single=True)
+            assert (retry["status"], retry["error"]) == ("queued", "disk unavailable")
+            assert claim_job() is None, "backoff delays the retry"
+
+            write_db("UPDATE jobs SET run_at = 0 WHERE id = ?", (job_id,))
+            work(once=True)
+            failed = query_db("SELECT * FROM jobs WHERE id = ?", (job_id,), single=True)
+    finally:
+        del HANDLERS["flaky"]
+
+    assert calls == [1, 2]
+    assert failed["status"] == "failed"
@@ -0,0 +1,117 @@
+import io
+import json
+import os
+import threading
+
+from flask import Flask
+from flask.testing import FlaskClient
+
+from app.observability import AccessLogWriter, get_access_log
+from tests.conftest import AuthActions
+
+
+def test_access_log_records_requests(app: Flask, client: FlaskClient, auth: AuthActions, tmp_path):
+    app.config["ACCESS_LOG"] = str(tmp_path / "access.log")
+    auth.login()
+    client.get("/dashboard/", headers={"User-Agent": "pytest"})
+
+    with app.app_context():
+        writer = get_access_log()
+        writer.close()
+
+    lines = (tmp_path / "access.log").read_text().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith('127.0.0.1 - "test user" [')
+    assert '"GET /dashboard/ HTTP/1.1" 200' in lines[1]
+    assert lines[1].endswith('"pytest"')
+    assert writer.stats()["written"] == 2
+
+
+def test_access_log_writer_drops_when_full(tmp_path, monkeypatch):
+    # Hold the writer thread back so the queue really is full.
+    release = threading.Event()
+    run = AccessLogWriter._run
+
+    def paused(self):
+        release.wait()
+        run(self)
+
+    monkeypatch.setattr(AccessLogWriter, "_run", paused)
+    writer = AccessLogWriter(str(tmp_path / "access.log"), max_queue=1, flush_interval=60)
+    writer.write("kept\n")
+    writer.write("dropped\n")
+
+    assert writer.stats()["dropped"] == 1
+    release.set()
+    writer.close()
+    assert (tmp_path / "access.log").read_text() == "kept\n"
+
+
+def test_access_log_writer_rotates_by_size(tmp_path):
+    path = str(tmp_path / "access.log")
+    writer = AccessLogWriter(path, batch_size=1, max_bytes=10, backup_count=2)
+    for i in range(4):
+        writer.write(f"line {i}\n")
+    writer.close()
+
+    assert open(path).read() == "line 3\n"
+    assert open(path + ".1").read() == "line 2\n"
+    assert open(path + ".2").read() == "line 1\n"
+    assert not os.path.exists(path + ".3")
+    assert writer.stats()["rotations"] == 3
+
+
+def test_metrics_endpoint(app: Flask, client: FlaskClient, auth: AuthActions, tmp_path):
+    assert client.get("/metrics").status_code == 404
+    app.config["METRICS_ENABLED"] = True
+    app.config["METRICS_DIR"] = str(tmp_path)
+    app.extensions.pop("metrics")
+    auth.login()
+    uploaded = client.post(
+        "/dashboard/upload",
+        data={"file": (io.BytesIO(b"metrics"), "metrics.txt")},
+        content_type="multipart/form-data",
+        headers={"Accept": "application/json"},
+    )
+    # Recorded when the server closes the body, after the request is over.
+    download = client.get(f"/dashboard/download/{uploaded.json['results'][0]['id']}")
+    assert download.data == b"metrics"
+    download.close()
+
+    # Another worker of the same server, as seen through its snapshot file.
+    sibling = tmp_path / f"{os.getppid()}-999999.json"
+    # It has exited: its counters still count, its gauges do not.
+    sibling.write_text(json.dumps([
+        ["http_requests_total", [["endpoint", "/login"], ["method", "POST"], ["status", 302]], 4],
+        ["access_log_queue_depth", [], 1000],
+    ]))
+    # A worker from a previous server run is ignored and cleaned up...
+    stale = tmp_path / "1-999998.json"
+    stale.write_text("[]")
+    # ...but one of another live server sharing the directory is kept.
+    other = tmp_path / f"1-{os.getpid()}.json"
+    other.write_text(json.dumps([["access_log_queue_depth", [], 500]]))
+
+    response = client.get("/metrics")
+    body = response.get_data(as_text=True)
+
+    assert response.mimetype == "text/plain"
+    assert 'http_requests_total{endpoint="/login",method="POST",status="302"} 5' in body
+    assert 'http_request_duration_seconds_bucket{endpoint="/dashboard/upload",le="+Inf"} 1' in body
+    assert 'transfer_bytes_total{direction="upload"} 7' in body
+    assert 'transfer_bytes_total{direction="download"} 7' in body
+    assert 'db_queries_total{kind="read"}' in body
+    assert "# TYPE db_query_duration_seconds histogram" in body
+    assert "access_log_queue_depth 1000" not in body
+    assert "access_log_queue_depth 500" not in body
+    assert not stale.exists()
+    assert other.exists()
+
+
+def test_metrics_endpoint_requires_token(app: Flask, client: FlaskClient):
+    app.config.update(METRICS_ENABLED=True, METRICS_TOKEN="scrape-secret")
+
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert response.status_code == 200
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import os
+import time
+
+import pytest
+from flask.testing import FlaskClient
+
+from app import resumable
+from app.db import query_db, write_db
+from app.jobs import work
+from tests.conftest import AuthActions
+
+
+def test_resumable_upload(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_SESSION_CHUNK_SIZE"] = 4
+    content = b"0123456789"
+    auth.login()
+
+    response = client.post("/dashboard/uploads", json={"filename": "resumed.txt", "size": len(content)})
+    assert response.status_code == 201
+    upload = response.get_json()
+    assert upload["chunk_count"] == 3
+
+    # Chunks may arrive in any order.
+    for index in (2, 0):
+        chunk = content[index * 4 : index * 4 + 4]
+        response = client.put(f"/dashboard/uploads/{upload['id']}/chunks/{index}", data=chunk)
+        assert response.status_code == 204
+
+    status = client.get(f"/dashboard/uploads/{upload['id']}").get_json()
+    assert status["received"] == [[0, 0], [2, 2]]
+    assert client.post(f"/dashboard/uploads/{upload['id']}/complete").status_code == 409
+
+    client.put(f"/dashboard/uploads/{upload['id']}/chunks/1", data=content[4:8])
+    response = client.post(f"/dashboard/uploads/{upload['id']}/complete")
+    assert response.status_code == 201
+    assert response.get_json()["checksum"] == hashlib.sha256(content).hexdigest()
+
+    with app.app_context():
+        file_record = query_db(
+            "SELECT * FROM files WHERE id = ?", (response.get_json()["file_id"],), single=True
+        )
+        assert query_db("SELECT * FROM upload_sessions") == []
+
+    with open(os.path.join(app.config["FILE_STORE"], file_record["file_path"]), "rb") as f:
+        assert f.read() == content
+
+
+def test_resumable_chunk_size_enforced(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_SESSION_CHUNK_SIZE"] = 4
+    auth.login()
+
+    upload = client.post("/dashboard/uploads", json={"filename": "a.txt", "size": 6}).get_json()
+
+    assert client.put(f"/dashboard/uploads/{upload['id']}/chunks/0", data=b"abc").status_code == 400
+    assert client.put(f"/dashboard/uploads/{upload['id']}/chunks/1", data=b"ef").status_code == 204
+    assert client.put(f"/dashboard/uploads/{upload['id']}/chunks/2", data=b"g").status_code == 416
+
+
+def test_resumable_upload_is_private(client: FlaskClient, auth: AuthActions):
+    auth.login()
+    upload = client.post("/dashboard/uploads", json={"filename": "a.txt", "size": 1}).get_json()
+
+    auth.logout()
+    auth.login(username="test user 2")
+
+    assert client.get(f"/dashboard/uploads/{upload['id']}").status_code == 404
+    assert client.delete(f"/dashboard/uploads/{upload['id']}").status_code == 404
+
+
+def test_resumable_upload_respects_quota(client: FlaskClient, auth: AuthActions, app):
+    app.config["USER_QUOTA_BYTES"] = 5
+    auth.login()
+
+    response = client.post("/dashboard/uploads", json={"filename": "big.txt", "size": 6})
+    assert response.status_code == 413
+    assert client.post("/dashboard/uploads", json={"filename": "ok.txt", "size": 5}).status_code == 201
+
+
+def test_resumable_upload_size_is_bounded(client: FlaskClient, auth: AuthActions, app):
+    app.config["UPLOAD_SESSION_MAX_SIZE"] = 100
+    auth.login()
+
+    for size in (101, 2**70):
+        response = client.post("/dashboard/uploads", json={"filename": "huge.bin", "size": size})
+        assert response.status_code == 413
+    assert client.post("/dashboard/uploads", json={"filename": "ok.bin", "size": 100}).status_code == 201
+
+
+def test_uploads_share_one_rate_limit(client: FlaskClient, auth: AuthActions, app):
+    app.config["RATE_LIMIT_UPLOAD"] = (3, 300.0)
+    auth.login()
+
+    response = client.post(
+        "/dashboard/upload",
+        data={"file": (io.BytesIO(b"a"), "a.txt")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 302
+    upload = client.post("/dashboard/uploads", json={"filename": "b.txt", "size": 1}).get_json()
+    assert client.put(f"/dashboard/uploads/{upload['id']}/chunks/0", data=b"b").status_code == 204
+
+    response = client.put(f"/dashboard/uploads/{upload['id']}/chunks/0", data=b"b")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert client.post("/dashboard/uploads", json={"filename": "c.txt", "size": 1}).status_code == 429
+
+
+def test_open_sessions_count_against_quota(client: FlaskClient, auth: AuthActions, app):
+    app.config["USER_QUOTA_BYTES"] = 10
+    auth.login()
+
+    first = client.post("/dashboard/uploads", json={"filename": "a.txt", "size": 6}).get_json()
+    response = client.post("/dashboard/uploads", json={"filename": "b.txt", "size": 5})
+    assert response.status_code == 413
+    assert b"quota of 4 bytes" in response.data
+
+    assert client.delete(f"/dashboard/uploads/{first['id']}").status_code == 204
+    assert client.post("/dashboard/uploads", json={"filename": "b.txt", "size": 5}).status_code == 201
+
+
+def test_chunk_after_partial_is_gone(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    upload = client.post("/dashboard/uploads", json={"filename": "a.txt", "size": 1}).get_json()
+    os.remove(os.path.join(app.config["FILE_STORE"], ".partial", upload["id"]))
+
+    assert client.put(f"/dashboard/uploads/{upload['id']}/chunks/0", data=b"a").status_code == 409
+
+
+def test_failed_completion_resets_session(client: FlaskClient, auth: AuthActions, app, monkeypatch):
+    auth.login()
+    upload = client.post("/dashboard/uploads", json={"filename": "a.txt", "size": 3}).get_json()
+    url = f"/dashboard/uploads/{upload['id']}"
+    client.put(f"{url}/chunks/0", data=b"abc")
+
+    def broken(received):
+        raise OSError("disk unavailable")
+
+    monkeypatch.setattr(resumable, "commit_blob", broken)
+    with pytest.raises(OSError):
+        client.post(f"{url}/complete")
+    monkeypatch.undo()
+
+    assert client.get(url).get_json()["received"] == []
+    assert client.put(f"{url}/chunks/0", data=b"abc").status_code == 204
+    assert client.post(f"{url}/complete").status_code == 201
+
+
+def test_abandoned_uploads_expire(client: FlaskClient, auth: AuthActions, app):
+    auth.login()
+    old = client.post("/dashboard/uploads", json={"filename": "old.txt", "size": 1}).get_json()
+    new = client.post("/dashboard/uploads", json={"filename": "new.txt", "size": 1}).get_json()
+    partials = os.path.join(app.config["FILE_STORE"], ".partial")
+    orphan = os.path.join(partials, "orphan")
+    open(orphan, "wb").close()
+    os.utime(orphan, (0, 0))
+
+    with app.app_context():
+        write_db(
+            "UPDATE upload_sessions SET created_at = datetime('now', '-2 days') WHERE id = ?",
+            (old["id"],),
+        )
+        assert len(query_db("SELECT * FROM jobs WHERE kind = 'expire_uploads'")) == 1
+        write_db("UPDATE jobs SET run_at = 0 WHERE kind = 'expire_uploads'")
+        assert work(once=True) == 1
+
+        assert [row["id"] for row in query_db("SELECT id FROM upload_sessions")] == [new["id"]]
+        queued = query_db("SELECT run_at FROM jobs WHERE status = 'queued'", single=True)
+        assert queued["run_at"] > time.time() + app.config["UPLOAD_SESSION_TTL"] - 60
+
+    assert sorted(os.listdir(partials)) == [new["id"]]